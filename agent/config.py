@@ -8,6 +8,8 @@ CONFIG_FILE = CONFIG_DIR / "settings.json"
 
 DEFAULT_CONFIG = {
     "default_provider": "openai",
+    "max_rounds": 50,
+    "context_window": 128000,
     "providers": {
         "openai": {
             "api_key": "",
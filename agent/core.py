@@ -1,17 +1,47 @@
+import importlib.util
 import json
 import os
-import uuid
+import secrets
 import time
 from pathlib import Path
 from datetime import datetime
-from typing import Union, Any
-from openai import OpenAI, APITimeoutError, RateLimitError, APIConnectionError, InternalServerError
-from anthropic import Anthropic, APIError as AnthropicAPIError, RateLimitError as AnthropicRateLimitError
-from .tools import TOOLS_SCHEMA, execute_tool, format_tool_call, get_plan_reminder, get_plan_final_reminder, set_session_id, restore_plan, set_work_dir
+from typing import TYPE_CHECKING, Union, Any, Optional, Tuple
+from functools import lru_cache
+from collections import deque
+from .tools import TOOLS_SCHEMA, execute_tool, format_tool_call, get_plan_reminder, get_plan_final_reminder, set_session_id, restore_plan, set_work_dir, atomic_write_bytes
 from . import tools as tools_module
 from .config import load_config, get_provider_config, CONFIG_FILE
 from .output import HumanWriter, JsonWriter
 import difflib
+try:
+    import orjson
+except ImportError:
+    orjson = None
+# h2 enables HTTP/2 in the SDKs' HTTP client; httpx imports it when needed
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+if TYPE_CHECKING:
+    # The provider SDKs take ~0.5-1s each to import; load only the one in use
+    from openai import OpenAI
+    from anthropic import Anthropic
+
+# Long completions may stream for minutes; an unreachable endpoint should fail fast
+HTTP_READ_TIMEOUT = 600.0
+HTTP_CONNECT_TIMEOUT = 5.0
+
+def _sdk_http_client(sdk):
+    # The SDK's own client class: its httpx flavour and keep-alive pool limits
+    return sdk.DefaultHttpxClient(
+        timeout=sdk.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        http2=HTTP2_AVAILABLE
+    )
+
+def create_llm_client(provider: str, api_key: str, base_url: str) -> Union["OpenAI", "Anthropic"]:
+    """Build the provider SDK client on a pooled keep-alive HTTP client."""
+    if provider == "anthropic":
+        import anthropic
+        return anthropic.Anthropic(api_key=api_key, base_url=base_url, http_client=_sdk_http_client(anthropic))
+    import openai
+    return openai.OpenAI(api_key=api_key, base_url=base_url, http_client=_sdk_http_client(openai))
 
 def _render_beautiful_diff(diff_text: str, max_lines: int = 50) -> str:
     if not diff_text:
@@ -258,16 +288,28 @@ def _render_beautiful_diff(diff_text: str, max_lines: int = 50) -> str:
     
     return '\n'.join(result)
 
+def _anthropic_tool_entry(func: dict) -> dict:
+    return {
+        "name": func["name"],
+        "description": func.get("description", ""),
+        "input_schema": func.get("parameters", {"type": "object", "properties": {}})
+    }
+
+# TOOLS_SCHEMA entries live for the whole process, so their ids are stable keys.
+_ANTHROPIC_TOOL_CACHE = {
+    id(tool): _anthropic_tool_entry(tool["function"])
+    for tool in TOOLS_SCHEMA
+    if tool.get("type") == "function"
+}
+
 def convert_tools_to_anthropic(openai_tools: list) -> list:
     anthropic_tools = []
     for tool in openai_tools:
-        if tool.get("type") == "function":
-            func = tool["function"]
-            anthropic_tools.append({
-                "name": func["name"],
-                "description": func.get("description", ""),
-                "input_schema": func.get("parameters", {"type": "object", "properties": {}})
-            })
+        cached = _ANTHROPIC_TOOL_CACHE.get(id(tool))
+        if cached is not None:
+            anthropic_tools.append(cached)
+        elif tool.get("type") == "function":
+            anthropic_tools.append(_anthropic_tool_entry(tool["function"]))
     return anthropic_tools
 
 def convert_messages_for_anthropic(openai_messages: list) -> tuple[str, list]:
@@ -306,7 +348,7 @@ def convert_messages_for_anthropic(openai_messages: list) -> tuple[str, list]:
                         "type": "tool_use",
                         "id": tc["id"],
                         "name": tc["function"]["name"],
-                        "input": json.loads(tc["function"]["arguments"])
+                        "input": json_loads(tc["function"]["arguments"])
                     })
                 anthropic_messages.append({"role": "assistant", "content": converted_content})
             else:
@@ -391,16 +433,18 @@ def convert_anthropic_to_openai_response(anthropic_response: Any, model: str) ->
     )
 
 def call_openai_with_retry(client, model: str, messages: list, tools: list, max_retries: int = 3, stream: bool = False, debug: bool = False):
+    from openai import APITimeoutError, RateLimitError, APIConnectionError, InternalServerError
     retryable_errors = (APITimeoutError, RateLimitError, APIConnectionError, InternalServerError)
     
     for attempt in range(max_retries + 1):
         try:
             kwargs = {
                 "model": model,
-                "messages": messages,
-                "tools": tools,
-                "tool_choice": "auto"
+                "messages": messages
             }
+            if tools:
+                kwargs["tools"] = tools
+                kwargs["tool_choice"] = "auto"
             if stream:
                 kwargs["stream"] = True
                 kwargs["stream_options"] = {"include_usage": True}
@@ -558,7 +602,8 @@ def convert_anthropic_stream_to_openai(anthropic_stream, model: str):
                     usage=usage
                 )
 
-def call_anthropic_with_retry(client: Anthropic, model: str, messages: list, tools: list, max_retries: int = 3, stream: bool = False, debug: bool = False):
+def call_anthropic_with_retry(client: "Anthropic", model: str, messages: list, tools: list, max_retries: int = 3, stream: bool = False, debug: bool = False):
+    from anthropic import APIError as AnthropicAPIError, RateLimitError as AnthropicRateLimitError
     retryable_errors = (AnthropicAPIError, AnthropicRateLimitError)
     
     for attempt in range(max_retries + 1):
@@ -638,34 +683,234 @@ def call_anthropic_with_retry(client: Anthropic, model: str, messages: list, too
         except Exception:
             raise
 
-def call_llm_api(client: Union[OpenAI, Anthropic], model: str, messages: list, tools: list, 
+def call_llm_api(client: Union["OpenAI", "Anthropic"], model: str, messages: list, tools: list, 
                  provider: str = "openai", max_retries: int = 3, stream: bool = False, debug: bool = False):
     if provider == "anthropic":
         return call_anthropic_with_retry(client, model, messages, tools, max_retries, stream, debug)
     else:
         return call_openai_with_retry(client, model, messages, tools, max_retries, stream, debug)
 
+def json_loads(data):
+    # orjson when installed; its decode errors subclass json.JSONDecodeError
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+DEFAULT_MAX_ROUNDS = 50
+
+def get_max_rounds(config: dict = None) -> int:
+    if config is None:
+        config = load_config()
+    try:
+        return max(1, int(config.get("max_rounds", DEFAULT_MAX_ROUNDS)))
+    except (TypeError, ValueError):
+        return DEFAULT_MAX_ROUNDS
+
+class ToolLoopGuard:
+    """Spots a model stuck re-issuing a call that keeps returning the same result."""
+
+    def __init__(self, window: int = 6, limit: int = 3):
+        self.window = window
+        self.limit = limit
+        self._recent = deque(maxlen=window)
+
+    def observe(self, name: str, arguments: dict, result: str) -> str:
+        """Record a finished call; return a notice to append to its result, or ""."""
+        args_key = json.dumps(arguments, sort_keys=True, ensure_ascii=False, default=str)
+        fingerprint = hash((name, args_key, result))
+        self._recent.append(fingerprint)
+        if self._recent.count(fingerprint) < self.limit:
+            return ""
+        return (
+            f"[SYSTEM NOTICE] {name} has returned this same result for identical arguments "
+            f"{self.limit} times in the last {self.window} tool calls. Repeating it will not help; "
+            "try a different approach or explain what is blocking you."
+        )
+
+DEFAULT_CONTEXT_WINDOW = 128000
+COMPACT_TRIGGER_RATIO = 0.7
+COMPACT_KEEP_ROUNDS = 4
+_COMPACT_CLIP_CHARS = 2000
+_SUMMARY_MARKER = "[CONVERSATION SUMMARY]"
+
+_COMPACT_PROMPT = (
+    "You compress the history of a coding agent's session. Summarize the transcript "
+    "below for the agent itself: the user's goals, decisions made, files read or changed "
+    "(with paths), important findings and command results, and what remains to be done. "
+    "Be concise and factual; keep exact paths, names and values. Output only the summary."
+)
+
+def get_context_window(config: dict = None) -> int:
+    """Context size in tokens that triggers compaction; 0 disables it."""
+    if config is None:
+        config = load_config()
+    try:
+        return max(0, int(config.get("context_window", DEFAULT_CONTEXT_WINDOW)))
+    except (TypeError, ValueError):
+        return DEFAULT_CONTEXT_WINDOW
+
+def should_compact(prompt_tokens: int, context_window: int) -> bool:
+    return context_window > 0 and prompt_tokens > context_window * COMPACT_TRIGGER_RATIO
+
+def _clip(text: str, limit: int = _COMPACT_CLIP_CHARS) -> str:
+    text = str(text or "")
+    return text if len(text) <= limit else text[:limit] + f"... [{len(text) - limit} chars omitted]"
+
+def _render_transcript(messages: list) -> str:
+    parts = []
+    for msg in messages:
+        role = msg.get("role")
+        content = msg.get("content") or ""
+        if role == "system":
+            parts.append(f"EARLIER SUMMARY:\n{content}")
+        elif role == "user":
+            parts.append(f"USER:\n{content}")
+        elif role == "assistant":
+            lines = [f"ASSISTANT:\n{content}"] if content else []
+            for tc in msg.get("tool_calls") or []:
+                fn = tc.get("function", {})
+                lines.append(f"CALL {fn.get('name', '')}({_clip(fn.get('arguments', ''), 500)})")
+            parts.append("\n".join(lines))
+        elif role == "tool":
+            parts.append(f"RESULT:\n{_clip(content)}")
+    return "\n\n".join(p for p in parts if p)
+
+def compact_messages(client: Union["OpenAI", "Anthropic"], model: str, provider: str, messages: list,
+                     keep_rounds: int = COMPACT_KEEP_ROUNDS, debug: bool = False) -> Optional[list]:
+    """Fold all but the last keep_rounds assistant rounds into one summary message.
+
+    The system prompt and the latest user request stay verbatim, and the cut
+    always lands on an assistant message so tool calls keep their results.
+    Returns the new list, or None when there is nothing to fold or the
+    summary call fails.
+    """
+    head = 1 if messages and messages[0].get("role") == "system" and not str(messages[0].get("content", "")).startswith(_SUMMARY_MARKER) else 0
+    rounds = [i for i in range(head, len(messages)) if messages[i].get("role") == "assistant"]
+    if len(rounds) <= keep_rounds:
+        return None
+    cut = rounds[-keep_rounds] if keep_rounds > 0 else len(messages)
+    anchor = next((i for i in range(cut - 1, head - 1, -1) if messages[i].get("role") == "user"), None)
+    if anchor is None:
+        return None
+
+    summary_request = [
+        {"role": "system", "content": _COMPACT_PROMPT},
+        {"role": "user", "content": _render_transcript(messages[head:cut])}
+    ]
+    try:
+        response = call_llm_api(client=client, model=model, messages=summary_request, tools=[], provider=provider, debug=debug)
+        summary = response.choices[0].message.content
+    except Exception:
+        return None
+    if not summary:
+        return None
+
+    return (
+        messages[:head]
+        + [{"role": "system", "content": f"{_SUMMARY_MARKER}\n{summary.strip()}"}]
+        + [messages[anchor]]
+        + messages[cut:]
+    )
+
 def get_session_dir() -> Path:
     session_dir = Path.home() / ".tricode" / "session"
     session_dir.mkdir(parents=True, exist_ok=True)
     return session_dir
 
-def save_session(session_id: str, messages: list) -> None:
-    session_file = get_session_dir() / f"{session_id}.json"
+# Sessions are JSONL logs, one message per line. Turns append their new
+# messages; save_session rewrites the whole log (new, rewound or legacy
+# .json sessions).
+
+def _encode_messages(messages: list) -> bytes:
+    if orjson is not None:
+        return b"".join(orjson.dumps(m, option=orjson.OPT_APPEND_NEWLINE) for m in messages)
+    return "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages).encode('utf-8')
+
+def write_session(session_id: str, messages: list) -> None:
+    """Rewrite the whole session log; raises on failure."""
+    session_dir = get_session_dir()
+    atomic_write_bytes(str(session_dir / f"{session_id}.jsonl"), _encode_messages(messages))
+    legacy_file = session_dir / f"{session_id}.json"
+    if legacy_file.exists():
+        legacy_file.unlink()
+
+def save_session(session_id: str, messages: list) -> bool:
+    try:
+        write_session(session_id, messages)
+        return True
+    except Exception as e:
+        print(f"Warning: Failed to save session {session_id}: {e}", flush=True)
+        return False
+
+def append_session_messages(session_id: str, new_messages: list) -> None:
+    if not new_messages:
+        return
+    session_file = get_session_dir() / f"{session_id}.jsonl"
+    with open(session_file, 'ab') as f:
+        f.write(_encode_messages(new_messages))
+
+def persist_session(session_id: str, messages: list, persisted_len: int) -> int:
+    """Write messages[persisted_len:] to the session log and return the new persisted length.
+
+    Falls back to a full rewrite when nothing has been written yet, the list
+    shrank, or the log is missing.
+    """
+    session_file = get_session_dir() / f"{session_id}.jsonl"
+    if persisted_len <= 0 or persisted_len > len(messages) or not session_file.exists():
+        return len(messages) if save_session(session_id, messages) else 0
     try:
-        with open(session_file, 'w', encoding='utf-8') as f:
-            json.dump(messages, f, ensure_ascii=False, indent=2)
+        append_session_messages(session_id, messages[persisted_len:])
     except Exception as e:
         print(f"Warning: Failed to save session {session_id}: {e}", flush=True)
+        return persisted_len
+    return len(messages)
+
+def read_session_file(session_file: Path) -> list:
+    # Binary mode: json_loads parses UTF-8 bytes without a separate decode pass
+    with open(session_file, 'rb') as f:
+        if session_file.suffix == ".json":
+            return json_loads(f.read())
+        messages = []
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                messages.append(json_loads(line))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                # torn line from an interrupted append
+                continue
+        return messages
+
+def list_session_files() -> list:
+    """Return (path, mtime) pairs, newest first.
+
+    A .jsonl log wins over a legacy .json of the same session. scandir
+    entries cache their stat, so each file is stat'ed once.
+    """
+    files = {}
+    with os.scandir(get_session_dir()) as entries:
+        for entry in entries:
+            stem, ext = os.path.splitext(entry.name)
+            if ext != ".jsonl" and (ext != ".json" or stem in files):
+                continue
+            try:
+                if entry.is_file():
+                    files[stem] = (Path(entry.path), entry.stat().st_mtime)
+            except OSError:
+                continue
+    return sorted(files.values(), key=lambda item: item[1], reverse=True)
 
 def load_session(session_id: str) -> list:
-    session_file = get_session_dir() / f"{session_id}.json"
+    session_dir = get_session_dir()
+    session_file = session_dir / f"{session_id}.jsonl"
+    if not session_file.exists():
+        session_file = session_dir / f"{session_id}.json"
     if not session_file.exists():
         raise FileNotFoundError(f"Session {session_id} not found")
     
     try:
-        with open(session_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return read_session_file(session_file)
     except Exception as e:
         raise ValueError(f"Failed to load session {session_id}: {e}")
 
@@ -676,7 +921,7 @@ def list_conversations() -> None:
         print("No conversations found.", flush=True)
         return
     
-    session_files = sorted(session_dir.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+    session_files = list_session_files()
     
     if not session_files:
         print("No conversations found.", flush=True)
@@ -684,14 +929,13 @@ def list_conversations() -> None:
     
     print(f"Available conversation sessions (stored in {session_dir}):\n", flush=True)
     
-    for session_file in session_files:
+    for session_file, mtime in session_files:
         session_id = session_file.stem
         
         try:
-            with open(session_file, 'r', encoding='utf-8') as f:
-                messages = json.load(f)
+            messages = read_session_file(session_file)
             
-            mtime = datetime.fromtimestamp(session_file.stat().st_mtime)
+            mtime = datetime.fromtimestamp(mtime)
             time_str = mtime.strftime("%Y-%m-%d %H:%M:%S")
             
             user_messages = [m for m in messages if m.get("role") == "user"]
@@ -713,26 +957,44 @@ def list_conversations() -> None:
             print(f"  {session_id} (error reading: {e})", flush=True)
             print(flush=True)
 
+_AGENTS_MD_CACHE = None
+
+def _mtime_ns(path: Path) -> Optional[int]:
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
 def load_agents_md() -> str:
+    # Re-read only when either file appears, disappears or changes.
+    global _AGENTS_MD_CACHE
+    local_path = Path.cwd() / "AGENTS.md"
+    global_path = Path.home() / ".tricode" / "AGENTS.md"
+    local_mtime = _mtime_ns(local_path)
+    global_mtime = _mtime_ns(global_path)
+    key = (str(local_path), local_mtime, global_mtime)
+    if _AGENTS_MD_CACHE is not None and _AGENTS_MD_CACHE[0] == key:
+        return _AGENTS_MD_CACHE[1]
+    
     agents_content = []
     
-    local_path = Path.cwd() / "AGENTS.md"
-    if local_path.exists():
+    if local_mtime is not None:
         try:
             with open(local_path, 'r', encoding='utf-8') as f:
                 agents_content.append(f.read().strip())
         except Exception as e:
             print(f"Warning: Failed to read {local_path}: {e}", flush=True)
     
-    global_path = Path.home() / ".tricode" / "AGENTS.md"
-    if global_path.exists():
+    if global_mtime is not None:
         try:
             with open(global_path, 'r', encoding='utf-8') as f:
                 agents_content.append(f.read().strip())
         except Exception as e:
             print(f"Warning: Failed to read {global_path}: {e}", flush=True)
     
-    return "\n\n".join(agents_content) if agents_content else ""
+    content = "\n\n".join(agents_content) if agents_content else ""
+    _AGENTS_MD_CACHE = (key, content)
+    return content
 
 def format_tool_result(tool_name: str, success: bool, result: str, arguments: dict = None) -> str:
     if not success:
@@ -743,7 +1005,7 @@ def format_tool_result(tool_name: str, success: bool, result: str, arguments: di
         # When with_metadata=true, the tool returns a JSON string and newlines are escaped, so counting \n is misleading.
         try:
             if arguments and arguments.get("with_metadata", False):
-                data = json.loads(result)
+                data = json_loads(result)
                 # Prefer explicit total_lines if present; otherwise fall back to counting content lines.
                 if isinstance(data, dict) and "total_lines" in data:
                     return f"[OK] read {data['total_lines']} lines"
@@ -762,7 +1024,7 @@ def format_tool_result(tool_name: str, success: bool, result: str, arguments: di
     elif tool_name == "edit_file":
         # CLI 简要统计，TUI 渲染原始 diff
         try:
-            result_data = json.loads(result)
+            result_data = json_loads(result)
             # Simple modes summary without diff
             mode = result_data.get("mode")
             if mode and mode != "patch":
@@ -879,20 +1141,20 @@ TOOL_DESCRIPTIONS = {
     "close_session": "Close an active session",
     "list_sessions": "List all active sessions",
     "fetch_url": "Fetch web content and convert to Markdown (HTTP/HTTPS only, no JS rendering)",
-    "web_search": "Search the web using DuckDuckGo and get results with titles, URLs, and snippets"
+    "web_search": "Search the web using DuckDuckGo and get results with titles, URLs, and snippets",
+    "get_diff": "Fetch the diff of a large edit_file change by its diff_id"
 }
 
+@lru_cache(maxsize=16)
+def _filter_tools_cached(allowed_key: Optional[tuple]) -> tuple:
+    if allowed_key is None:
+        return tuple(TOOLS_SCHEMA)
+    return tuple(tool for tool in TOOLS_SCHEMA if tool["function"]["name"] in allowed_key)
+
 def filter_tools_schema(allowed_tools: list = None) -> list:
-    if allowed_tools is None:
-        return TOOLS_SCHEMA
-    
-    filtered = []
-    for tool in TOOLS_SCHEMA:
-        tool_name = tool["function"]["name"]
-        if tool_name in allowed_tools:
-            filtered.append(tool)
-    
-    return filtered
+    # Filtered once per allowlist; every session shares the same schema entries
+    allowed_key = tuple(allowed_tools) if allowed_tools is not None else None
+    return list(_filter_tools_cached(allowed_key))
 
 def build_tools_description(allowed_tools: list = None) -> str:
     if allowed_tools is None:
@@ -918,6 +1180,16 @@ def build_system_prompt(allowed_tools: list = None, override_system_prompt: bool
     Returns:
         Complete system prompt string
     """
+    tools_key = tuple(allowed_tools) if allowed_tools is not None else None
+    prefix, suffix = _system_prompt_template(tools_key, override_system_prompt, tools_module.WORK_DIR, load_agents_md())
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S %A")
+    return f"{prefix}{current_time}{suffix}"
+
+@lru_cache(maxsize=16)
+def _system_prompt_template(allowed_tools: Optional[tuple], override_system_prompt: bool, work_dir: str, agents_md_content: str) -> Tuple[str, str]:
+    # Everything but the timestamp, split around it: prompt = prefix + time + suffix.
+    # Stable content comes first and per-session values last, so prompts
+    # share the longest possible prefix for provider-side prompt caching.
     tools_desc = build_tools_description(allowed_tools)
     
     has_session_tools = (
@@ -931,14 +1203,11 @@ def build_system_prompt(allowed_tools: list = None, override_system_prompt: bool
         "Your goal is to complete user requests efficiently and intelligently.\n\n"
     )
     
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S %A")
-    time_section = (
-        f"CURRENT LOCAL TIME: {current_time}\n"
-        f"Use this timestamp when processing time-related requests.\n\n"
-    )
+    time_prefix = "CURRENT LOCAL TIME: "
+    time_suffix = "\nUse this timestamp when processing time-related requests."
     
     work_dir_section = (
-        f"WORKING DIRECTORY: {tools_module.WORK_DIR}\n"
+        f"WORKING DIRECTORY: {work_dir}\n"
         f"All relative paths (like '.', 'file.txt', 'subdir/') are relative to this directory.\n\n"
     )
     
@@ -1018,16 +1287,12 @@ def build_system_prompt(allowed_tools: list = None, override_system_prompt: bool
         "Explain what tools would be needed and do not attempt to complete the task with inappropriate tools."
     )
     
-    agents_md_content = load_agents_md()
-    
-    if agents_md_content and override_system_prompt:
-        system_prompt = time_section + work_dir_section + tools_section + "\n\n" + agents_md_content
-    elif agents_md_content:
-        system_prompt = base_identity + time_section + work_dir_section + tools_section + "\n\n" + agents_md_content
-    else:
-        system_prompt = base_identity + time_section + work_dir_section + tools_section
-    
-    return system_prompt
+    stable = tools_section
+    if agents_md_content:
+        stable += "\n\n" + agents_md_content
+    if not (agents_md_content and override_system_prompt):
+        stable = base_identity + stable
+    return stable + "\n\n" + work_dir_section + time_prefix, time_suffix
 
 def run_agent(user_input: str, verbose: bool = False, stdio_mode: bool = False, override_system_prompt: bool = False, resume_session_id: str = None, allowed_tools: list = None, work_dir: str = None, bypass_work_dir_limit: bool = False, bypass_permission: bool = False, debug: bool = False, provider_name: str = None) -> str:
     set_work_dir(work_dir, bypass_work_dir_limit)
@@ -1043,10 +1308,7 @@ def run_agent(user_input: str, verbose: bool = False, stdio_mode: bool = False,
     provider = provider_config["provider"]
     model = provider_config["model"]
     
-    if provider == "anthropic":
-        client = Anthropic(api_key=api_key, base_url=base_url)
-    else:
-        client = OpenAI(api_key=api_key, base_url=base_url)
+    client = create_llm_client(provider, api_key, base_url)
     
     writer = JsonWriter() if stdio_mode else HumanWriter(verbose)
     
@@ -1061,7 +1323,7 @@ def run_agent(user_input: str, verbose: bool = False, stdio_mode: bool = False,
         except (FileNotFoundError, ValueError) as e:
             return f"Error: {e}"
     else:
-        session_id = str(uuid.uuid4())[:8]
+        session_id = secrets.token_hex(4)
         set_session_id(session_id)
         writer.write_system(f"Session ID: {session_id}")
         messages = None
@@ -1075,12 +1337,27 @@ def run_agent(user_input: str, verbose: bool = False, stdio_mode: bool = False,
         ]
     
     filtered_tools = filter_tools_schema(allowed_tools)
+    persisted_len = 0
+    max_rounds = get_max_rounds()
+    context_window = get_context_window()
+    context_tokens = 0
+    loop_guard = ToolLoopGuard()
     
     round_num = 0
     while True:
         round_num += 1
+        if round_num > max_rounds:
+            return f"Error: stopped after {max_rounds} rounds without a final answer"
         writer.write_round(round_num)
         
+        if should_compact(context_tokens, context_window):
+            compacted = compact_messages(client, model, provider, messages, debug=debug)
+            if compacted is not None:
+                writer.write_system(f"Compacted {len(messages) - len(compacted) + 1} earlier messages into a summary")
+                messages = compacted
+                persisted_len = persist_session(session_id, messages, 0)
+            context_tokens = 0
+        
         try:
             response = call_llm_api(
                 client=client,
@@ -1097,6 +1374,8 @@ def run_agent(user_input: str, verbose: bool = False, stdio_mode: bool = False,
             return "OpenAI API error: Invalid response from API"
         
         message = response.choices[0].message
+        if getattr(response, "usage", None) is not None:
+            context_tokens = response.usage.prompt_tokens + response.usage.completion_tokens
         
         if not message.tool_calls:
             if round_num > 1:
@@ -1108,7 +1387,7 @@ def run_agent(user_input: str, verbose: bool = False, stdio_mode: bool = False,
                         "role": "assistant",
                         "content": assistant_content
                     })
-                    save_session(session_id, messages)
+                    persisted_len = persist_session(session_id, messages, persisted_len)
                     continue
             final_content = message.content or "No response generated"
             writer.write_final(final_content)
@@ -1116,7 +1395,7 @@ def run_agent(user_input: str, verbose: bool = False, stdio_mode: bool = False,
                 "role": "assistant",
                 "content": final_content
             })
-            save_session(session_id, messages)
+            persisted_len = persist_session(session_id, messages, persisted_len)
             return ""
         
         messages.append({
@@ -1134,12 +1413,13 @@ def run_agent(user_input: str, verbose: bool = False, stdio_mode: bool = False,
             ]
         })
         
-        tool_results = []
+        # One tool message per call, filled in call order
+        tool_messages = [None] * len(message.tool_calls)
         deny_triggered = False
         for idx, tool_call in enumerate(message.tool_calls):
             func_name = tool_call.function.name
             try:
-                func_args = json.loads(tool_call.function.arguments)
+                func_args = json_loads(tool_call.function.arguments)
             except json.JSONDecodeError:
                 func_args = {}
 
@@ -1148,16 +1428,16 @@ def run_agent(user_input: str, verbose: bool = False, stdio_mode: bool = False,
                 formatted_result = format_tool_result(func_name, False, denial_text, func_args)
                 writer.write_tool_call(func_name, func_args, format_tool_call(func_name, func_args))
                 writer.write_tool_result(func_name, False, denial_text, formatted_result)
-                tool_results.append({
-                    "tool_call_id": tool_call.id,
-                    "content": denial_text
-                })
+                tool_messages[idx] = {"role": "tool", "tool_call_id": tool_call.id, "content": denial_text}
                 continue
 
             formatted_call = format_tool_call(func_name, func_args)
             writer.write_tool_call(func_name, func_args, formatted_call)
 
             success, result = execute_tool(func_name, func_args)
+            notice = loop_guard.observe(func_name, func_args, result)
+            if notice:
+                result = f"{result}\n\n{notice}"
 
             formatted_result = format_tool_result(func_name, success, result, func_args)
             writer.write_tool_result(func_name, success, result, formatted_result)
@@ -1166,24 +1446,18 @@ def run_agent(user_input: str, verbose: bool = False, stdio_mode: bool = False,
             if not success and isinstance(result, str) and result.startswith("Denied:"):
                 deny_triggered = True
 
-            tool_results.append({
-                "tool_call_id": tool_call.id,
-                "content": result
-            })
+            tool_messages[idx] = {"role": "tool", "tool_call_id": tool_call.id, "content": result}
+            # Rough estimate until the next response reports real usage
+            context_tokens += len(str(result)) // 4
         
         reminder = get_plan_reminder()
-        if reminder and round_num >= 1 and tool_results:
+        if reminder and round_num >= 1 and tool_messages:
             writer.write_reminder(reminder)
-            tool_results[-1]["content"] += f"\n\n{reminder}"
+            tool_messages[-1]["content"] += f"\n\n{reminder}"
         
-        for tool_result in tool_results:
-            messages.append({
-                "role": "tool",
-                "tool_call_id": tool_result["tool_call_id"],
-                "content": tool_result["content"]
-            })
+        messages.extend(tool_messages)
         
-        save_session(session_id, messages)
+        persisted_len = persist_session(session_id, messages, persisted_len)
         
         # If denial happened, do not perform another API request this round
         if deny_triggered:
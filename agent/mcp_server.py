@@ -364,7 +364,7 @@ TOOL_DEFINITIONS = [
                 },
                 "hunks": {
                     "type": "array",
-                    "description": "Patch operations for mode='patch'. Each hunk: op replace|insert_before|insert_after|delete with anchor (exact/regex).",
+                    "description": "Patch operations for mode='patch'. Each hunk: op replace|insert_before|insert_after|delete with anchor (exact/regex). Anchors match the file as read, not the output of earlier hunks; hunks must not overlap.",
                     "items": {
                         "type": "object",
                         "properties": {
@@ -442,6 +442,11 @@ TOOL_DEFINITIONS = [
                     "type": "boolean",
                     "description": "Preview changes without applying them",
                     "default": False
+                },
+                "include_diff": {
+                    "type": "boolean",
+                    "description": "Return a unified diff of the applied change. Set false to skip diff generation when only confirmation is needed; dry runs always include it.",
+                    "default": True
                 }
             },
             "required": ["path"]
@@ -667,6 +672,26 @@ TOOL_DEFINITIONS = [
             "required": ["query"]
         }
     ),
+    Tool(
+        name="get_diff",
+        description="Fetch the unified diff of a large edit_file change by the diff_id it returned.",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "diff_id": {
+                    "type": "string",
+                    "description": "diff_id returned by edit_file"
+                },
+                "timeout": {
+                    "type": "integer",
+                    "description": "Timeout in seconds",
+                    "default": 10,
+                    "minimum": 1
+                }
+            },
+            "required": ["diff_id"]
+        }
+    ),
     Tool(
         name="plan",
         description="Create and manage task plans. Supports creating, updating, and tracking task status.",
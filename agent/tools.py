@@ -4,23 +4,38 @@ import re
 
 import subprocess
 import tempfile
+import mmap
 from typing import Tuple, Dict, Optional
 from datetime import datetime
 import stat
 import threading
-import queue
+from collections import deque
 import time
-import uuid
+import random
+import secrets
 import json
 from pathlib import Path
 import socket
+import ipaddress
 from urllib.parse import urlparse
 import requests
 import html2text
 from bs4 import BeautifulSoup
 from ddgs import DDGS
 import difflib
+try:
+    # Optional C matcher; difflib.unified_diff picks it up transparently.
+    from cdifflib import CSequenceMatcher
+    difflib.SequenceMatcher = CSequenceMatcher
+except ImportError:
+    pass
 import hashlib
+import codecs
+from bisect import bisect_right
+import atexit
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from agent.symbol_search import SymbolBlock, search_symbol_blocks, collect_all_symbol_blocks
 from agent.reference_search import (
@@ -35,16 +50,28 @@ CURRENT_SESSION_ID = None
 PLAN_DECISION_MADE = False
 SIGNIFICANT_ACTIONS_COUNT = 0
 LAST_PLAN_UPDATE_AT = 0
+_PLAN_RENDER = None
 
 WORK_DIR = None
+_WORK_DIR_PREFIX = None
 BYPASS_WORK_DIR_LIMIT = False
 BYPASS_PERMISSION = False
 BYPASS_PLAN_CHECK = False
 EXIT_ON_TERMINATE = True
 SESSION_APPROVED_TOOLS = set()
 PERMISSION_CALLBACK = None
-LAST_WEB_SEARCH_TIME = 0
 WEB_SEARCH_RATE_LIMIT = 1.5
+WEB_SEARCH_BURST = 2
+WEB_SEARCH_USER_AGENTS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 14_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Safari/605.1.15",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0",
+)
+HTTP_USER_AGENT = "Mozilla/5.0 (compatible; TriCode/1.0)"
+_HTTP_LOCAL = threading.local()
+_HTTP_SESSIONS = []
+_HTTP_SESSIONS_LOCK = threading.Lock()
 
 DESTRUCTIVE_TOOLS = {
     "create_file", "edit_file", "run_command",
@@ -52,18 +79,43 @@ DESTRUCTIVE_TOOLS = {
     "delete_file", "delete_path", "mkdir"
 }
 
+SIGNIFICANT_ACTION_TOOLS = frozenset({
+    "read_file", "edit_file", "create_file", "delete_file",
+    "delete_path", "mkdir", "run_command"
+})
+
+# Read-only tools that may run concurrently within one assistant turn
+PARALLEL_SAFE_TOOLS = frozenset({
+    "read_file", "search_context", "list_directory", "search_symbol",
+    "list_symbols", "search_references", "fetch_url", "web_search",
+    "list_sessions", "get_diff"
+})
+
+# Local read-only tools whose results can be reused until state changes
+CACHEABLE_TOOLS = frozenset({
+    "read_file", "search_context", "list_directory", "search_symbol",
+    "list_symbols", "search_references"
+})
+_PLAN_COUNTER_LOCK = threading.Lock()
+
+_PLAN_DIR = Path.home() / ".tricode" / "plans"
+_plan_dir_ready = False
+
 def get_plan_dir() -> Path:
-    plan_dir = Path.home() / ".tricode" / "plans"
-    plan_dir.mkdir(parents=True, exist_ok=True)
-    return plan_dir
+    global _plan_dir_ready
+    if not _plan_dir_ready:
+        _PLAN_DIR.mkdir(parents=True, exist_ok=True)
+        _plan_dir_ready = True
+    return _PLAN_DIR
 
 def set_work_dir(work_dir: str = None, bypass: bool = False) -> None:
-    global WORK_DIR, BYPASS_WORK_DIR_LIMIT
+    global WORK_DIR, _WORK_DIR_PREFIX, BYPASS_WORK_DIR_LIMIT
     BYPASS_WORK_DIR_LIMIT = bypass
     if work_dir:
         WORK_DIR = os.path.realpath(work_dir)
     else:
         WORK_DIR = os.path.realpath(os.getcwd())
+    _WORK_DIR_PREFIX = WORK_DIR + os.sep
 
 def set_bypass_permission(bypass: bool = False) -> None:
     global BYPASS_PERMISSION
@@ -104,16 +156,18 @@ def resolve_path(path: str) -> str:
         return os.path.realpath(os.path.join(WORK_DIR, expanded))
 
 def validate_path(path: str) -> Tuple[bool, str]:
+    """Check that a path from resolve_path() lies inside WORK_DIR.
+
+    The path must already be canonical; it is not passed through realpath again.
+    """
     if BYPASS_WORK_DIR_LIMIT:
         return True, ""
+    if _WORK_DIR_PREFIX is None:
+        return False, "Path validation error: work directory is not set"
     
-    try:
-        real_path = os.path.realpath(path)
-        if not real_path.startswith(WORK_DIR + os.sep) and real_path != WORK_DIR:
-            return False, f"Access denied: {path} is outside work directory {WORK_DIR}"
-        return True, ""
-    except Exception as e:
-        return False, f"Path validation error: {str(e)}"
+    if path != WORK_DIR and not path.startswith(_WORK_DIR_PREFIX):
+        return False, f"Access denied: {path} is outside work directory {WORK_DIR}"
+    return True, ""
 def ask_user_permission(tool_name: str, arguments: dict) -> Tuple[bool, bool, str]:
     if BYPASS_PERMISSION:
         return True, False, ""
@@ -196,13 +250,90 @@ def ask_user_permission(tool_name: str, arguments: dict) -> Tuple[bool, bool, st
             print("\nOperation cancelled by user.", flush=True)
             return False, True, f"User cancelled {tool_name} operation"
 
+def _fsync_dir(dir_path: str) -> None:
+    # persist the directory entry after a rename; not supported on Windows
+    if os.name != "posix":
+        return
+    try:
+        dir_fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+def atomic_write_bytes(path: str, data: bytes, exclusive: bool = False, mode: Optional[int] = None) -> None:
+    """Write data to a sibling temp file, fsync it, then move it into place.
+
+    With exclusive=True the target must not exist; FileExistsError is raised
+    instead of replacing it. mode, if given, is applied to the new file.
+    """
+    dir_path = os.path.dirname(path) or "."
+    tmp_path = os.path.join(dir_path, f".{os.path.basename(path)}.{secrets.token_hex(4)}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            if mode is not None and hasattr(os, "fchmod"):
+                os.fchmod(fd, mode)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if mode is not None and not hasattr(os, "fchmod"):
+            # no fchmod on Windows before 3.13
+            os.chmod(tmp_path, mode)
+        if exclusive:
+            try:
+                os.link(tmp_path, path)
+            except FileExistsError:
+                raise
+            except OSError:
+                # no hard links on this filesystem: claim the name, then replace it
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+                os.replace(tmp_path, path)
+            else:
+                os.unlink(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    _fsync_dir(dir_path)
+
+def _encode_for_write(text: str) -> bytes:
+    # same newline translation a text-mode write applies (CRLF on Windows)
+    if os.linesep != "\n":
+        text = text.replace("\n", os.linesep)
+    return text.encode('utf-8')
+
+def _existing_mode(path: str) -> Optional[int]:
+    # permission bits to carry over when a file is rewritten via atomic_write_bytes
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        return None
+
 def save_plan_state(session_id: str, plan_data: dict) -> None:
+    global _plan_dir_ready
     if not session_id:
         return
     plan_file = get_plan_dir() / f"{session_id}.json"
     try:
-        with open(plan_file, 'w', encoding='utf-8') as f:
-            json.dump(plan_data, f, ensure_ascii=False, indent=2)
+        data = json.dumps(plan_data, ensure_ascii=False, indent=2).encode('utf-8')
+        try:
+            atomic_write_bytes(str(plan_file), data)
+        except FileNotFoundError:
+            # plan dir was removed while we were running; recreate it once
+            _plan_dir_ready = False
+            atomic_write_bytes(str(get_plan_dir() / plan_file.name), data)
     except Exception as e:
         print(f"Warning: Failed to save plan for session {session_id}: {e}", flush=True)
 
@@ -254,6 +385,8 @@ def get_plan_final_reminder() -> str:
 
 ACTIVE_SESSIONS: Dict[str, dict] = {}
 SESSION_LOCK = threading.Lock()
+# Wakes the cleanup thread when a session is added so it can recompute its deadline.
+SESSION_CV = threading.Condition(SESSION_LOCK)
 MAX_SESSIONS = 3
 SESSION_TIMEOUT = 300
 SESSION_IDLE_TIMEOUT = 30
@@ -388,7 +521,7 @@ TOOLS_SCHEMA = [
                     },
                     "hunks": {
                         "type": "array",
-                        "description": "Patch operations for mode='patch'. Each hunk: op replace|insert_before|insert_after|delete with anchor (exact/regex).",
+                        "description": "Patch operations for mode='patch'. Each hunk: op replace|insert_before|insert_after|delete with anchor (exact/regex). Anchors match the file as read, not the output of earlier hunks; hunks must not overlap.",
                         "items": {
                             "type": "object",
                             "properties": {
@@ -418,7 +551,8 @@ TOOLS_SCHEMA = [
                             "file_sha256": {"type": "string", "description": "Optional whole-file sha256 to guard against stale edits"}
                         }
                     },
-                    "dry_run": {"type": "boolean", "default": False}
+                    "dry_run": {"type": "boolean", "default": False},
+                    "include_diff": {"type": "boolean", "default": True, "description": "Return a unified diff of the applied change. Set false to skip diff generation when only confirmation is needed; dry runs always include it."}
                 },
                 "required": ["path"]
             }
@@ -686,6 +820,28 @@ TOOLS_SCHEMA = [
                 "required": ["query"]
             }
         }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_diff",
+            "description": "Fetch the unified diff of a large edit_file change. Edits to files over 256 KiB return a diff_id instead of an inline diff; pass it here. Each diff can be fetched once.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "diff_id": {
+                        "type": "string",
+                        "description": "The diff_id returned by edit_file"
+                    },
+                    "timeout": {
+                        "type": "integer",
+                        "description": "Maximum time to wait for the diff in seconds",
+                        "default": 10
+                    }
+                },
+                "required": ["diff_id"]
+            }
+        }
     }
 ]
 
@@ -853,19 +1009,26 @@ def search_symbol(
 
 
 def _render_symbol_block(block: SymbolBlock) -> Tuple[bool, str]:
+    if block.start_line < 1:
+        return False, f"Start line out of range for {block.filepath}"
     try:
-        with open(block.filepath, "r", encoding="utf-8", errors="ignore") as handle:
-            lines = handle.readlines()
+        with open(block.filepath, "rb") as handle:
+            size = os.fstat(handle.fileno()).st_size
+            if size == 0:
+                return False, f"Start line out of range for {block.filepath}"
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                begin, end, total = _line_window(mm, size, block.start_line, block.end_line)
+                raw = mm[begin:end]
     except Exception as exc:
         return False, f"Read failed for {block.filepath}: {str(exc)}"
 
-    if block.start_line < 1 or block.start_line > len(lines):
+    if total is not None and block.start_line > total:
         return False, f"Start line out of range for {block.filepath}"
-    end_line = min(block.end_line, len(lines))
+    end_line = block.end_line if total is None else min(block.end_line, total)
     if end_line < block.start_line:
         end_line = block.start_line
 
-    slice_content = "".join(lines[block.start_line - 1 : end_line])
+    slice_content = _normalize_newlines(raw.decode("utf-8", errors="ignore"))
     numbered = _with_line_numbers(slice_content, block.start_line)
     header = f"{block.filepath}:{block.start_line}-{end_line}"
 
@@ -1276,6 +1439,55 @@ def search_references(
 
 
 
+SEARCH_TIMEOUT = 10
+SEARCH_OUTPUT_LIMIT = 1024 * 1024
+
+def _run_rg(pattern: str, path: str) -> Tuple[int, str, str]:
+    """Run rg and stream its output, stopping once SEARCH_OUTPUT_LIMIT is hit.
+
+    Returns (returncode, stdout, stderr). Raises FileNotFoundError if rg is missing.
+    """
+    with tempfile.TemporaryFile() as err_file:
+        process = subprocess.Popen(
+            ["rg", "-n", "--", pattern, path],
+            stdout=subprocess.PIPE,
+            stderr=err_file,
+            bufsize=1024 * 1024
+        )
+        timed_out = threading.Event()
+
+        def _on_timeout():
+            timed_out.set()
+            process.kill()
+
+        timer = threading.Timer(SEARCH_TIMEOUT, _on_timeout)
+        timer.start()
+        chunks = []
+        total = 0
+        truncated = False
+        try:
+            for line in process.stdout:
+                total += len(line)
+                if total > SEARCH_OUTPUT_LIMIT:
+                    truncated = True
+                    process.kill()
+                    break
+                chunks.append(line)
+            process.stdout.close()
+            returncode = process.wait()
+        finally:
+            timer.cancel()
+        if timed_out.is_set() and not truncated:
+            raise TimeoutError(f"rg timed out after {SEARCH_TIMEOUT} seconds")
+        err_file.seek(0)
+        stderr = err_file.read().decode("utf-8", errors="replace")
+
+    stdout = b"".join(chunks).decode("utf-8", errors="replace")
+    if truncated:
+        stdout += f"[output truncated at {SEARCH_OUTPUT_LIMIT} bytes; narrow the pattern or path]\n"
+        returncode = 0
+    return returncode, stdout, stderr
+
 def search_context(pattern: str, path: str = ".") -> Tuple[bool, str]:
     resolved_path = resolve_path(path)
     valid, err_msg = validate_path(resolved_path)
@@ -1283,60 +1495,103 @@ def search_context(pattern: str, path: str = ".") -> Tuple[bool, str]:
         return False, err_msg
 
     try:
-        result = subprocess.run(
-            ["rg", "-n", "--", pattern, resolved_path],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        if result.returncode == 0:
-            return True, result.stdout
-        elif result.returncode == 1:
+        returncode, stdout, stderr_text = _run_rg(pattern, resolved_path)
+        if returncode == 0:
+            return True, stdout
+        elif returncode == 1:
             return True, "No matches found"
         else:
-            stderr_text = result.stderr or ""
             if "regex parse error" in stderr_text:
                 escaped = re.escape(pattern)
-                retry = subprocess.run(
-                    ["rg", "-n", "--", escaped, resolved_path],
-                    capture_output=True,
-                    text=True,
-                    timeout=10
-                )
-                if retry.returncode == 0:
-                    return True, retry.stdout
-                elif retry.returncode == 1:
+                returncode, stdout, retry_stderr = _run_rg(escaped, resolved_path)
+                if returncode == 0:
+                    return True, stdout
+                elif returncode == 1:
                     return True, "No matches found"
-                return False, f"Search error: {retry.stderr}"
+                return False, f"Search error: {retry_stderr}"
             return False, f"Search error: {stderr_text}"
     except FileNotFoundError:
         return _fallback_search(pattern, resolved_path)
     except Exception as e:
         return False, f"Search failed: {str(e)}"
 
+# Line-end/start assertions and lookarounds see a lone line differently from
+# the same line inside the whole buffer
+_LINE_CONTEXT_RE = re.compile(r"\$|\\[ABZ]|\(\?<?[=!]")
+
 def _fallback_search(pattern: str, path: str) -> Tuple[bool, str]:
-    """Fallback text search when ripgrep is not available."""
+    """Fallback text search when ripgrep is not available.
+
+    Each file is decoded once and scanned as a single buffer, so the regex
+    engine skips non-matching lines in C. Every reported line is confirmed
+    by searching that line alone, so results match a per-line search.
+    """
     try:
         try:
-            regex = re.compile(pattern)
+            line_regex = re.compile(pattern)
         except re.error:
-            regex = re.compile(re.escape(pattern))
+            line_regex = re.compile(re.escape(pattern))
+        regex = re.compile(line_regex.pattern, re.MULTILINE)
+        # these can match a lone line but nowhere in the buffer; scan line by line
+        per_line = _LINE_CONTEXT_RE.search(line_regex.pattern) is not None
+
+        if os.path.isfile(path):
+            targets = [path]
+        else:
+            targets = (
+                os.path.join(root, file)
+                for root, _, files in os.walk(path)
+                for file in files
+            )
 
         results = []
-        for root, _, files in os.walk(path):
-            for file in files:
-                filepath = os.path.join(root, file)
-                try:
-                    with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
-                        for i, line in enumerate(f, 1):
-                            if regex.search(line):
-                                results.append(f"{filepath}:{i}:{line.rstrip()}")
-                except Exception:
-                    continue
+        for filepath in targets:
+            try:
+                with open(filepath, "rb") as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        continue
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        if mm.find(b"\0", 0, 8192) != -1:
+                            continue
+                        text = mm[:].decode("utf-8", errors="ignore")
+            except Exception:
+                continue
+            if "\r" in text:
+                # universal newlines, as text-mode reading gave
+                text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+            pos = 0
+            line_no = 1
+            counted = 0
+            while pos < len(text):
+                if per_line:
+                    line_start = pos
+                else:
+                    match = regex.search(text, pos)
+                    if match is None:
+                        break
+                    line_start = text.rfind("\n", 0, match.start()) + 1
+                line_end = text.find("\n", line_start)
+                if line_end == -1:
+                    line_end = len(text)
+                # the line plus its newline, as per-line iteration yields it
+                if line_regex.search(text[line_start:line_end + 1]):
+                    line_no += text.count("\n", counted, line_start)
+                    counted = line_start
+                    results.append(f"{filepath}:{line_no}:{text[line_start:line_end].rstrip()}")
+                pos = line_end + 1
         return True, "\n".join(results) if results else "No matches found"
     except Exception as e:
         return False, f"Fallback search failed: {str(e)}"
 
+def _classify(path: str) -> Tuple[bool, bool, int]:
+    """Return (exists, is_link, st_mode) from a single lstat call."""
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return False, False, 0
+    return True, stat.S_ISLNK(mode), mode
+
 def delete_path(path: str, recursive: bool = False) -> Tuple[bool, str]:
     """Delete a file or a directory. For directories, allow recursive removal when requested."""
     resolved_path = resolve_path(path)
@@ -1344,14 +1599,15 @@ def delete_path(path: str, recursive: bool = False) -> Tuple[bool, str]:
     if not valid:
         return False, err_msg
     try:
-        if not os.path.exists(resolved_path) and not os.path.islink(resolved_path):
+        exists, is_link, mode = _classify(resolved_path)
+        if not exists:
             return False, f"Path not found: {resolved_path}"
-        if os.path.realpath(resolved_path) == os.path.realpath(WORK_DIR):
+        if resolved_path == WORK_DIR:
             return False, f"Refusing to delete the work directory root: {resolved_path}"
-        if os.path.isfile(resolved_path) or os.path.islink(resolved_path):
+        if is_link or stat.S_ISREG(mode):
             os.unlink(resolved_path)
             return True, f"Deleted file: {resolved_path}"
-        if os.path.isdir(resolved_path):
+        if stat.S_ISDIR(mode):
             if recursive:
                 shutil.rmtree(resolved_path)
                 return True, f"Deleted directory recursively: {resolved_path}"
@@ -1379,6 +1635,44 @@ def _with_line_numbers(content: str, start_number: int = 1) -> str:
     return ''.join(numbered_chunks)
 
 
+def _normalize_newlines(text: str) -> str:
+    """Translate CRLF/CR to LF, matching text-mode universal newlines."""
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
+def _line_window(mm, size: int, start: int, requested_end: Optional[int]) -> Tuple[int, int, Optional[int]]:
+    """Locate the byte span of lines start..end in a mapped file.
+
+    Scans newlines only as far as the last requested line. Lines end at
+    \n, \r\n or a lone \r, as with universal-newline reading. Returns
+    (begin, end, total); total is None when the scan stopped early.
+    """
+    target = max(start, requested_end) if requested_end is not None else None
+    begin = size
+    offset = 0
+    line = 1
+    # next b'\n' / b'\r' at or after offset, -1 once none are left
+    nl = cr = -2
+    while offset < size:
+        if line == start:
+            begin = offset
+        if nl != -1 and nl < offset:
+            nl = mm.find(b'\n', offset)
+        if cr != -1 and cr < offset:
+            cr = mm.find(b'\r', offset)
+        if cr != -1 and (nl == -1 or cr < nl):
+            nxt = cr + 2 if cr + 1 == nl else cr + 1
+        else:
+            nxt = size if nl == -1 else nl + 1
+        if line == target:
+            return begin, nxt, None
+        offset = nxt
+        line += 1
+    return begin, size, line - 1
+
+
 def read_file(path: str, start_line: int = None, end_line: int = None, max_bytes: int = None, with_metadata: bool = False) -> Tuple[bool, str]:
     """Simple file read with optional line window and byte cap.
     Full file by default; clamps safely when limited.
@@ -1391,20 +1685,23 @@ def read_file(path: str, start_line: int = None, end_line: int = None, max_bytes
     try:
         line_start = 1
         note = None
-        with open(resolved_path, 'r', encoding='utf-8') as f:
+        with open(resolved_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
             if start_line is not None:
-                lines = f.readlines()
-                total = len(lines)
                 s = max(1, int(start_line))
                 requested_end = int(end_line) if end_line is not None else None
-                e = requested_end if requested_end is not None else total
-                e = max(s, min(e, total))
-                content = ''.join(lines[s-1:e])
-                if requested_end is not None and requested_end > total:
+                if size == 0:
+                    raw, total = b'', 0
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        begin, end, total = _line_window(mm, size, s, requested_end)
+                        raw = mm[begin:end]
+                content = _normalize_newlines(raw.decode('utf-8'))
+                if requested_end is not None and total is not None and requested_end > total:
                     note = "NOTE: Requested end_line exceeds file length; this is all available content.\n"
                 line_start = s
             else:
-                content = f.read()
+                content = _normalize_newlines(f.read().decode('utf-8'))
  
         if isinstance(max_bytes, int) and max_bytes is not None and max_bytes >= 0:
             b = content.encode('utf-8')
@@ -1439,9 +1736,10 @@ def delete_file(path: str) -> Tuple[bool, str]:
     if not valid:
         return False, err_msg
     try:
-        if not os.path.exists(resolved_path) and not os.path.islink(resolved_path):
+        exists, _, mode = _classify(resolved_path)
+        if not exists:
             return False, f"File not found: {resolved_path}"
-        if os.path.isdir(resolved_path) and not os.path.islink(resolved_path):
+        if stat.S_ISDIR(mode):
             return False, f"Is a directory: {resolved_path}. Use delete_path for directories."
         os.unlink(resolved_path)
         return True, f"Deleted file: {resolved_path}"
@@ -1458,8 +1756,9 @@ def mkdir(path: str, parents: bool = True, exist_ok: bool = False) -> Tuple[bool
         return False, err_msg
     try:
         # If path exists already
-        if os.path.exists(resolved_path):
-            if os.path.isdir(resolved_path):
+        exists, _, mode = _classify(resolved_path)
+        if exists:
+            if stat.S_ISDIR(mode):
                 if exist_ok:
                     return True, f"Directory exists: {resolved_path}"
                 return False, f"Directory already exists: {resolved_path}"
@@ -1470,8 +1769,6 @@ def mkdir(path: str, parents: bool = True, exist_ok: bool = False) -> Tuple[bool
             os.makedirs(resolved_path, exist_ok=exist_ok)
         else:
             # If parent doesn't exist and parents=False, this will raise
-            if exist_ok and os.path.isdir(resolved_path):
-                return True, f"Directory exists: {resolved_path}"
             os.mkdir(resolved_path)
 
         return True, f"Created directory: {resolved_path}"
@@ -1491,24 +1788,14 @@ def create_file(path: str, content: str) -> Tuple[bool, str]:
         return False, err_msg
     
     try:
-        if os.path.exists(resolved_path):
-            return False, f"File already exists: {resolved_path}. Use edit_file to modify existing files."
-        
         dir_path = os.path.dirname(resolved_path)
         if dir_path and not os.path.exists(dir_path):
             os.makedirs(dir_path)
         
-        with tempfile.NamedTemporaryFile(
-            mode='w',
-            encoding='utf-8',
-            dir=dir_path or '.',
-            delete=False
-        ) as tmp:
-            tmp.write(content)
-            tmp_path = tmp.name
-        
-        os.rename(tmp_path, resolved_path)
+        atomic_write_bytes(resolved_path, _encode_for_write(content), exclusive=True)
         return True, f"Successfully created {resolved_path}"
+    except FileExistsError:
+        return False, f"File already exists: {resolved_path}. Use edit_file to modify existing files."
     except Exception as e:
         return False, f"Create failed: {str(e)}"
 
@@ -1519,28 +1806,22 @@ def _compute_sha256(text: str) -> str:
     return h.hexdigest()
 
 
+_NEWLINE_RE = re.compile('\n')
+
+
 def _index_to_line(idx: int, line_starts: list) -> int:
     # binary search to map byte offset to 1-based line number
-    lo, hi = 0, len(line_starts) - 1
-    while lo <= hi:
-        mid = (lo + hi) // 2
-        if line_starts[mid] <= idx:
-            lo = mid + 1
-        else:
-            hi = mid - 1
-    return hi + 1
+    return bisect_right(line_starts, idx)
 
 
 def _build_line_starts(text: str) -> list:
     # record start offset for each line (1-based lines)
     starts = [0]
-    for i, ch in enumerate(text):
-        if ch == '\n':
-            starts.append(i + 1)
+    starts.extend(m.end() for m in _NEWLINE_RE.finditer(text))
     return starts
 
 
-def _find_matches(text: str, anchor: dict) -> list:
+def _find_matches(text: str, anchor: dict, line_starts: list = None) -> list:
     # return list of (start, end) spans for anchor
     a_type = anchor.get("type")
     pattern = anchor.get("pattern", "")
@@ -1550,7 +1831,8 @@ def _find_matches(text: str, anchor: dict) -> list:
         try:
             start_line, end_line = anchor.get("range")
             if isinstance(start_line, int) and isinstance(end_line, int) and start_line >= 1 and end_line >= start_line:
-                line_starts = _build_line_starts(text)
+                if line_starts is None:
+                    line_starts = _build_line_starts(text)
                 # clamp to file length
                 max_line = _index_to_line(len(text), line_starts)
                 end_line = min(end_line, max_line)
@@ -1584,45 +1866,110 @@ def _find_matches(text: str, anchor: dict) -> list:
             for m in rgx.finditer(search_text)
         ]
     elif a_type == "exact":
-        spans = []
-        start = 0
-        while True:
-            i = search_text.find(pattern, start)
-            if i == -1:
-                break
-            spans.append((base_offset + i, base_offset + i + len(pattern)))
-            start = i + (1 if len(pattern) == 0 else max(1, len(pattern)))
-        return spans
+        # Escaped literal keeps the scan inside _sre; spans stay char-indexed.
+        return [
+            (base_offset + m.start(), base_offset + m.end())
+            for m in re.finditer(re.escape(pattern), search_text)
+        ]
     else:
         raise ValueError("Unsupported anchor.type; use 'exact' or 'regex'")
 
 
-def edit_file(path: str, hunks: list = None, precondition: dict = None, dry_run: bool = False, mode: str = "patch", content: str = None) -> Tuple[bool, str]:
+def _render_diff(old_text: str, new_text: str, from_label: str, to_label: str) -> str:
+    # unified diff of a whole-file change; empty for no-op edits
+    if old_text == new_text:
+        return ""
+    return ''.join(difflib.unified_diff(
+        old_text.splitlines(keepends=True),
+        new_text.splitlines(keepends=True),
+        fromfile=from_label,
+        tofile=to_label,
+        lineterm='\n'
+    ))
+
+# Diffs of files above this size are built on _DIFF_EXECUTOR so the edit
+# returns as soon as the write lands; get_diff collects them.
+ASYNC_DIFF_THRESHOLD = 256 * 1024
+_PENDING_DIFFS_MAX = 32
+_DIFF_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="edit-diff")
+_PENDING_DIFFS: Dict[str, object] = {}
+_PENDING_DIFFS_LOCK = threading.Lock()
+
+def _submit_diff(old_text: str, new_text: str, from_label: str, to_label: str) -> str:
+    diff_id = secrets.token_hex(4)
+    future = _DIFF_EXECUTOR.submit(_render_diff, old_text, new_text, from_label, to_label)
+    with _PENDING_DIFFS_LOCK:
+        _PENDING_DIFFS[diff_id] = future
+        # drop the oldest unclaimed diffs rather than hold them forever
+        while len(_PENDING_DIFFS) > _PENDING_DIFFS_MAX:
+            _PENDING_DIFFS.pop(next(iter(_PENDING_DIFFS))).cancel()
+    return diff_id
+
+def get_diff(diff_id: str, timeout: int = 10) -> Tuple[bool, str]:
+    with _PENDING_DIFFS_LOCK:
+        future = _PENDING_DIFFS.get(diff_id)
+    if future is None:
+        return False, f"Diff not found: {diff_id}"
+    try:
+        diff_text = future.result(timeout=timeout)
+    except FutureTimeoutError:
+        return False, f"Diff {diff_id} is still being computed; call get_diff again"
+    except Exception as e:
+        return False, f"Diff failed: {str(e)}"
+    finally:
+        if future.done():
+            with _PENDING_DIFFS_LOCK:
+                _PENDING_DIFFS.pop(diff_id, None)
+    return True, diff_text or "No changes"
+
+
+def _suggest_anchor_line(text: str, pattern: str) -> str:
+    # point at the closest line when an exact anchor misses (typo, whitespace drift)
+    needle = next((ln.strip() for ln in pattern.splitlines() if ln.strip()), "")
+    if not needle:
+        return ""
+    lines = text.splitlines()[:20000]
+    stripped = [ln.strip() for ln in lines]
+    best = difflib.get_close_matches(needle, stripped, n=1, cutoff=0.6)
+    if not best:
+        return ""
+    line_no = stripped.index(best[0]) + 1
+    return f" Closest line {line_no}: {lines[line_no - 1][:120]!r}"
+
+
+def edit_file(path: str, hunks: list = None, precondition: dict = None, dry_run: bool = False, mode: str = "patch", content: str = None, include_diff: bool = True) -> Tuple[bool, str]:
     """Unified edit entry with simple modes and patch mode.
     Simple: overwrite/append/prepend with top-level content; Patch: anchor-based hunks.
     Precondition is optional: mismatch aborts if provided, otherwise proceed.
+    include_diff=False omits the diff from applied results; dry runs always carry it.
     """
     resolved_path = resolve_path(path)
     valid, err_msg = validate_path(resolved_path)
     if not valid:
         return False, err_msg
+    base = os.path.basename(resolved_path)
+    from_label = f"a/{base}"
+    to_label = f"b/{base}"
 
     mode = (mode or "patch").strip().lower()
     if mode not in ("overwrite", "append", "prepend", "patch"):
         return False, f"Unsupported mode: {mode}"
 
     original_text = ""
+    raw = b""
     existed = os.path.exists(resolved_path)
     try:
         if existed:
-            with open(resolved_path, 'r', encoding='utf-8') as f:
-                original_text = f.read()
+            # one read: the hash and the text come from the same bytes
+            with open(resolved_path, 'rb') as f:
+                raw = f.read()
+            original_text = _normalize_newlines(raw.decode('utf-8'))
         elif mode != "overwrite" and not dry_run:
             return False, f"File not found: {resolved_path}"
 
+        sha256_before = hashlib.sha256(raw).hexdigest()
         if precondition and precondition.get("file_sha256"):
-            cur = _compute_sha256(original_text)
-            if cur != precondition.get("file_sha256"):
+            if sha256_before != precondition.get("file_sha256"):
                 return False, "Precondition failed: file sha256 mismatch"
 
         if mode in ("overwrite", "append", "prepend"):
@@ -1635,72 +1982,56 @@ def edit_file(path: str, hunks: list = None, precondition: dict = None, dry_run:
             else:
                 new_text = content + (original_text or "")
 
+            want_diff = dry_run or include_diff
+            async_diff = want_diff and not dry_run and len(original_text or "") > ASYNC_DIFF_THRESHOLD
+            diff_text = _render_diff(original_text or "", new_text or "", from_label, to_label) if want_diff and not async_diff else None
+            data = _encode_for_write(new_text)
             if dry_run:
-                diff = difflib.unified_diff(
-                    (original_text or "").splitlines(keepends=True),
-                    (new_text or "").splitlines(keepends=True),
-                    fromfile=f"a/{os.path.basename(resolved_path)}",
-                    tofile=f"b/{os.path.basename(resolved_path)}",
-                    lineterm='\n'
-                )
-                diff_text = ''.join(diff)
                 result = {
                     "success": True,
                     "path": resolved_path,
                     "applied": False,
                     "mode": mode,
-                    "bytes_new": len(new_text.encode('utf-8')),
+                    "bytes_new": len(data),
                     "diff": diff_text
                 }
                 return True, json.dumps(result)
 
-            dir_path = os.path.dirname(resolved_path)
-            with tempfile.NamedTemporaryFile(
-                mode='w',
-                encoding='utf-8',
-                dir=dir_path or '.',
-                delete=False
-            ) as tmp:
-                tmp.write(new_text)
-                tmp_path = tmp.name
-            os.rename(tmp_path, resolved_path)
-
-            diff = difflib.unified_diff(
-                (original_text or "").splitlines(keepends=True),
-                (new_text or "").splitlines(keepends=True),
-                fromfile=f"a/{os.path.basename(resolved_path)}",
-                tofile=f"b/{os.path.basename(resolved_path)}",
-                lineterm='\n'
-            )
-            diff_text = ''.join(diff)
+            atomic_write_bytes(resolved_path, data, mode=_existing_mode(resolved_path))
 
             result = {
                 "success": True,
                 "path": resolved_path,
                 "applied": True,
                 "mode": mode,
-                "sha256_before": _compute_sha256(original_text),
-                "sha256_after": _compute_sha256(new_text),
-                "bytes_written": len(new_text.encode('utf-8')),
-                "diff": diff_text,
+                "sha256_before": sha256_before,
+                "sha256_after": hashlib.sha256(data).hexdigest(),
+                "bytes_written": len(data),
                 "created": not existed and mode == "overwrite"
             }
+            if async_diff:
+                result["diff_id"] = _submit_diff(original_text or "", new_text or "", from_label, to_label)
+            elif want_diff:
+                result["diff"] = diff_text
             return True, json.dumps(result)
 
-        # Patch mode
-        text = original_text
+        # Patch mode: every anchor resolves against the file as read, then all
+        # edits are spliced in one ordered pass.
         applied = 0
         matches_meta = []
+        edits = []
         if not hunks:
             return False, "Missing hunks for patch mode"
 
+        line_starts = _build_line_starts(original_text)
+        text_len = len(original_text)
         for h in hunks:
             op = h.get("op")
             anchor = h.get("anchor") or {}
             must_unique = h.get("must_unique", False)
             h_content = h.get("content", "")
 
-            spans = _find_matches(text, anchor)
+            spans = _find_matches(original_text, anchor, line_starts)
             if not spans:
                 hint = ""
                 if anchor.get("type") == "regex":
@@ -1709,6 +2040,8 @@ def edit_file(path: str, hunks: list = None, precondition: dict = None, dry_run:
                         hint = " Consider setting anchor.dotall=true or using [\\s\\S]*? for multi-line matches."
                 if anchor.get("range"):
                     hint += " Verify that anchor.range covers the intended lines."
+                if anchor.get("type") == "exact":
+                    hint += _suggest_anchor_line(original_text, anchor.get("pattern", ""))
                 return False, f"Anchor not found for op={op}.{hint}"
 
             nth = anchor.get("nth")
@@ -1726,39 +2059,47 @@ def edit_file(path: str, hunks: list = None, precondition: dict = None, dry_run:
                 return False, "Requested occurrence not found"
 
             s, e = spans[idx]
-            line_starts = _build_line_starts(text)
             start_line = _index_to_line(s, line_starts)
             end_line = _index_to_line(e - 1 if e > s else s, line_starts)
 
             if op == "replace":
-                text = text[:s] + h_content + text[e:]
+                edits.append((s, e, h_content))
             elif op == "insert_before":
-                text = text[:s] + h_content + text[s:]
+                edits.append((s, s, h_content))
             elif op == "insert_after":
-                text = text[:e] + h_content + text[e:]
+                edits.append((e, e, h_content))
             elif op == "delete":
-                text = text[:s] + text[e:]
+                edits.append((s, e, ""))
             else:
                 return False, f"Unsupported op: {op}"
 
             applied += 1
-            snippet = original_text[s:e] if (s < len(original_text) and e <= len(original_text)) else ""
+            # slice only the 120 chars reported, not the whole matched span
+            snippet = original_text[s:min(e, s + 120)] if s < text_len else ""
             matches_meta.append({
                 "op": op,
                 "start_line": start_line,
                 "end_line": end_line,
-                "anchor_snippet": snippet[:120]
+                "anchor_snippet": snippet
             })
 
+        # stable sort keeps hunk order for edits at the same offset
+        edits.sort(key=lambda edit: (edit[0], edit[1]))
+        parts = []
+        pos = 0
+        for s, e, payload in edits:
+            if s < pos:
+                return False, "Hunks overlap: two hunks edit the same region. Merge them into one hunk."
+            parts.append(original_text[pos:s])
+            parts.append(payload)
+            pos = e
+        parts.append(original_text[pos:])
+        text = ''.join(parts)
+
+        want_diff = dry_run or include_diff
+        async_diff = want_diff and not dry_run and len(original_text) > ASYNC_DIFF_THRESHOLD
+        diff_text = _render_diff(original_text, text, from_label, to_label) if want_diff and not async_diff else None
         if dry_run:
-            diff = difflib.unified_diff(
-                original_text.splitlines(keepends=True),
-                text.splitlines(keepends=True),
-                fromfile=f"a/{os.path.basename(resolved_path)}",
-                tofile=f"b/{os.path.basename(resolved_path)}",
-                lineterm='\n'
-            )
-            diff_text = ''.join(diff)
             result = {
                 "success": True,
                 "path": resolved_path,
@@ -1770,25 +2111,8 @@ def edit_file(path: str, hunks: list = None, precondition: dict = None, dry_run:
             }
             return True, json.dumps(result)
 
-        dir_path = os.path.dirname(resolved_path)
-        with tempfile.NamedTemporaryFile(
-            mode='w',
-            encoding='utf-8',
-            dir=dir_path or '.',
-            delete=False
-        ) as tmp:
-            tmp.write(text)
-            tmp_path = tmp.name
-        os.rename(tmp_path, resolved_path)
-
-        diff = difflib.unified_diff(
-            original_text.splitlines(keepends=True),
-            text.splitlines(keepends=True),
-            fromfile=f"a/{os.path.basename(resolved_path)}",
-            tofile=f"b/{os.path.basename(resolved_path)}",
-            lineterm='\n'
-        )
-        diff_text = ''.join(diff)
+        data = _encode_for_write(text)
+        atomic_write_bytes(resolved_path, data, mode=_existing_mode(resolved_path))
 
         result = {
             "success": True,
@@ -1797,14 +2121,25 @@ def edit_file(path: str, hunks: list = None, precondition: dict = None, dry_run:
             "mode": "patch",
             "hunks_applied": applied,
             "matches": matches_meta,
-            "sha256_before": _compute_sha256(original_text),
-            "sha256_after": _compute_sha256(text),
-            "diff": diff_text
+            "sha256_before": sha256_before,
+            "sha256_after": hashlib.sha256(data).hexdigest()
         }
+        if async_diff:
+            result["diff_id"] = _submit_diff(original_text, text, from_label, to_label)
+        elif want_diff:
+            result["diff"] = diff_text
         return True, json.dumps(result)
     except Exception as e:
         return False, f"Edit failed: {str(e)}"
 
+def _format_entry(entry: os.DirEntry) -> str:
+    try:
+        st = entry.stat(follow_symlinks=False)
+        mtime = datetime.fromtimestamp(st.st_mtime).strftime('%b %d %H:%M')
+        return f"{stat.filemode(st.st_mode)} {st.st_nlink:3} {st.st_size:8} {mtime} {entry.name}"
+    except Exception as e:
+        return f"????????? ??? ???????? ??? ??? {entry.name} [Error: {str(e)}]"
+
 def list_directory(
     path: str = ".",
     show_hidden: bool = False,
@@ -1815,59 +2150,23 @@ def list_directory(
     if not valid:
         return False, err_msg
     
+    path = resolved_path
     try:
-        cmd = ["ls", "-la"] if show_hidden else ["ls", "-l"]
-        if recursive:
-            cmd.append("-R")
-        result = subprocess.run(
-            cmd + [resolved_path],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        if result.returncode == 0:
-            return True, result.stdout.strip()
-        else:
-            return False, f"ls command error: {result.stderr}"
-    except FileNotFoundError:
-        return _fallback_list_directory(resolved_path, show_hidden, recursive)
-    except Exception as e:
-        return _fallback_list_directory(resolved_path, show_hidden, recursive)
-
-def _fallback_list_directory(
-    path: str,
-    show_hidden: bool = False,
-    recursive: bool = False
-) -> Tuple[bool, str]:
-    try:
-        if not os.path.exists(path):
+        try:
+            path_mode = os.stat(path).st_mode
+        except FileNotFoundError:
             return False, f"Path not found: {path}"
         
-        if not os.path.isdir(path):
+        if not stat.S_ISDIR(path_mode):
             return False, f"Not a directory: {path}"
         
-        def collect_directory(dir_path: str) -> Tuple[list, list]:
-            entries = []
-            subdirs = []
-            items = os.listdir(dir_path)
-            if not show_hidden:
-                items = [item for item in items if not item.startswith('.')]
-            items.sort()
-            for item in items:
-                full_path = os.path.join(dir_path, item)
-                try:
-                    stat_info = os.lstat(full_path)
-                    mode = stat_info.st_mode
-                    perms = stat.filemode(mode)
-                    nlink = stat_info.st_nlink
-                    size = stat_info.st_size
-                    mtime = datetime.fromtimestamp(stat_info.st_mtime).strftime('%b %d %H:%M')
-                    entries.append(f"{perms} {nlink:3} {size:8} {mtime} {item}")
-                    if recursive and os.path.isdir(full_path) and not os.path.islink(full_path):
-                        subdirs.append(full_path)
-                except Exception as e:
-                    entries.append(f"????????? ??? ???????? ??? ??? {item} [Error: {str(e)}]")
-            return entries, subdirs
+        def scan(dir_path: str) -> list:
+            # scandir hands back d_type with each name, so is_dir() needs no extra stat
+            with os.scandir(dir_path) as it:
+                return sorted(
+                    (entry for entry in it if show_hidden or not entry.name.startswith('.')),
+                    key=lambda entry: entry.name,
+                )
         
         if recursive:
             sections = []
@@ -1877,42 +2176,52 @@ def _fallback_list_directory(
                 if current_path in visited:
                     return
                 visited.add(current_path)
-                entries, subdirs = collect_directory(current_path)
-                block_lines = [f"{current_path}:"]
-                if entries:
-                    block_lines.extend(entries)
-                else:
-                    block_lines.append("Empty directory")
-                sections.append("\n".join(block_lines))
-                for subdir in subdirs:
-                    walk(subdir)
+                items = scan(current_path)
+                body = "\n".join(map(_format_entry, items)) or "Empty directory"
+                sections.append(f"{current_path}:\n{body}")
+                for entry in items:
+                    if entry.is_dir(follow_symlinks=False):
+                        walk(entry.path)
             
             walk(path)
             return True, "\n\n".join(sections)
         
-        entries, _ = collect_directory(path)
-        if not entries:
-            return True, "Empty directory"
-        return True, "\n".join(entries)
+        return True, "\n".join(map(_format_entry, scan(path))) or "Empty directory"
     except PermissionError:
         return False, f"Permission denied: {path}"
     except Exception as e:
         return False, f"List failed: {str(e)}"
 
+_ANSI_RESET = "\033[0m"
+_TASK_COLOR = {
+    "pending": ("\033[31m", _ANSI_RESET),
+    "in_progress": ("\033[33m", _ANSI_RESET),
+    "completed": ("\033[32m", _ANSI_RESET)
+}
+_NO_COLOR = ("", "")
+
+def _format_plan_task(task: dict, is_first: bool = False) -> str:
+    color, reset = _TASK_COLOR.get(task["status"], _NO_COLOR)
+    prefix = "↳ " if is_first else "  "
+    return f"{prefix}- {color}{task['desc']}{reset}"
+
+def _render_plan(changed_index: Optional[int] = None) -> str:
+    # Rendered rows are cached per plan object; an update re-formats only its row.
+    global _PLAN_RENDER
+    tasks = CURRENT_PLAN["tasks"]
+    cached = _PLAN_RENDER
+    if cached is None or cached[0] is not CURRENT_PLAN or len(cached[1]) != len(tasks):
+        lines = [_format_plan_task(task, is_first=(i == 0)) for i, task in enumerate(tasks)]
+        _PLAN_RENDER = (CURRENT_PLAN, lines)
+    else:
+        lines = cached[1]
+        if changed_index is not None:
+            lines[changed_index] = _format_plan_task(tasks[changed_index], is_first=(changed_index == 0))
+    return "\n".join(lines)
+
 def plan(action: str, tasks: list = None, task_id: int = None, status: str = None, reason: str = None) -> Tuple[bool, str]:
     global CURRENT_PLAN, PLAN_DECISION_MADE, SIGNIFICANT_ACTIONS_COUNT, LAST_PLAN_UPDATE_AT
     
-    def format_task(task, is_first=False):
-        color_map = {
-            "pending": "\033[31m",
-            "in_progress": "\033[33m",
-            "completed": "\033[32m"
-        }
-        color = color_map.get(task["status"], "")
-        reset = "\033[0m" if color else ""
-        prefix = "↳ " if is_first else "  "
-        return f"{prefix}- {color}{task['desc']}{reset}"
-    
     if action == "create":
         if not tasks or not isinstance(tasks, list):
             return False, "Create action requires 'tasks' parameter as a list"
@@ -1925,10 +2234,7 @@ def plan(action: str, tasks: list = None, task_id: int = None, status: str = Non
         LAST_PLAN_UPDATE_AT = 0
         if CURRENT_SESSION_ID:
             save_plan_state(CURRENT_SESSION_ID, CURRENT_PLAN)
-        result = []
-        for i, task in enumerate(CURRENT_PLAN["tasks"]):
-            result.append(format_task(task, is_first=(i==0)))
-        return True, "\n".join(result)
+        return True, _render_plan()
     
     elif action == "skip":
         PLAN_DECISION_MADE = True
@@ -1941,28 +2247,22 @@ def plan(action: str, tasks: list = None, task_id: int = None, status: str = Non
         if task_id is None or status is None:
             return False, "Update action requires 'task_id' and 'status' parameters"
         
-        task = next((t for t in CURRENT_PLAN["tasks"] if t["id"] == task_id), None)
-        if not task:
+        index = next((i for i, t in enumerate(CURRENT_PLAN["tasks"]) if t["id"] == task_id), None)
+        if index is None:
             return False, f"Task ID {task_id} not found"
         
-        task["status"] = status
+        CURRENT_PLAN["tasks"][index]["status"] = status
         SIGNIFICANT_ACTIONS_COUNT = 0
         LAST_PLAN_UPDATE_AT = SIGNIFICANT_ACTIONS_COUNT
         if CURRENT_SESSION_ID:
             save_plan_state(CURRENT_SESSION_ID, CURRENT_PLAN)
-        result = []
-        for i, t in enumerate(CURRENT_PLAN["tasks"]):
-            result.append(format_task(t, is_first=(i==0)))
-        return True, "\n".join(result)
+        return True, _render_plan(changed_index=index)
     
     elif action == "check":
         if CURRENT_PLAN is None:
             return False, "No plan exists. Create a plan first."
         
-        result = []
-        for i, task in enumerate(CURRENT_PLAN["tasks"]):
-            result.append(format_task(task, is_first=(i==0)))
-        return True, "\n".join(result)
+        return True, _render_plan()
     
     else:
         return False, f"Unknown action: {action}"
@@ -1994,39 +2294,60 @@ def run_command(command: str, timeout: int = 30) -> Tuple[bool, str]:
     except Exception as e:
         return False, f"Execution failed: {str(e)}"
 
-def _read_stream(stream, output_queue, stream_name):
+def _read_stream(stream, output_queue, output_event, stream_name):
     try:
         for line in iter(stream.readline, ''):
             if line:
-                output_queue.put((stream_name, line))
+                output_queue.append((stream_name, line))
+                output_event.set()
     except Exception:
         pass
     finally:
         stream.close()
 
+def _terminate_process(process) -> None:
+    # The caller must already have popped the session from ACTIVE_SESSIONS and
+    # must not hold SESSION_LOCK: wait() can block for up to 2 seconds.
+    if process.poll() is not None:
+        return
+    try:
+        process.terminate()
+        process.wait(timeout=2)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
 def _cleanup_expired_sessions():
     while True:
-        time.sleep(10)
-        with SESSION_LOCK:
-            now = time.time()
+        with SESSION_CV:
+            now = time.monotonic()
             expired = []
+            next_deadline = None
             for sid, session in ACTIVE_SESSIONS.items():
-                idle_time = now - session["last_accessed"]
-                total_time = now - session["created_at"]
-                if idle_time > SESSION_IDLE_TIMEOUT or total_time > SESSION_TIMEOUT:
+                deadline = min(
+                    session["last_accessed"] + SESSION_IDLE_TIMEOUT,
+                    session["created_at"] + SESSION_TIMEOUT
+                )
+                if deadline < now:
                     expired.append(sid)
+                elif next_deadline is None or deadline < next_deadline:
+                    next_deadline = deadline
             
-            for sid in expired:
-                session = ACTIVE_SESSIONS[sid]
-                try:
-                    session["process"].terminate()
-                    session["process"].wait(timeout=2)
-                except Exception:
-                    try:
-                        session["process"].kill()
-                    except Exception:
-                        pass
-                del ACTIVE_SESSIONS[sid]
+            if not expired:
+                # Sleep until the earliest deadline, or indefinitely with no sessions.
+                # Activity only pushes deadlines later, so an early wake just recomputes.
+                timeout = None if next_deadline is None else max(0.1, next_deadline - now)
+                SESSION_CV.wait(timeout=timeout)
+                continue
+            
+            # Once popped, the sessions belong to this thread alone.
+            expired_sessions = [ACTIVE_SESSIONS.pop(sid) for sid in expired]
+        
+        for session in expired_sessions:
+            try:
+                _terminate_process(session["process"])
+            except Exception:
+                pass
 
 _cleanup_thread = threading.Thread(target=_cleanup_expired_sessions, daemon=True)
 _cleanup_thread.start()
@@ -2046,53 +2367,64 @@ def start_session(command: str, shell: str = "/bin/bash") -> Tuple[bool, str]:
                 bufsize=1
             )
             
-            session_id = str(uuid.uuid4())[:8]
-            output_queue = queue.Queue()
+            session_id = secrets.token_hex(4)
+            # deque append/popleft are atomic; the event wakes a waiting read_output
+            output_queue = deque()
+            output_event = threading.Event()
             
             stdout_thread = threading.Thread(
                 target=_read_stream,
-                args=(process.stdout, output_queue, "stdout"),
+                args=(process.stdout, output_queue, output_event, "stdout"),
                 daemon=True
             )
             stderr_thread = threading.Thread(
                 target=_read_stream,
-                args=(process.stderr, output_queue, "stderr"),
+                args=(process.stderr, output_queue, output_event, "stderr"),
                 daemon=True
             )
             
             stdout_thread.start()
             stderr_thread.start()
             
-            ACTIVE_SESSIONS[session_id] = {
+            session = {
                 "process": process,
                 "output_queue": output_queue,
-                "created_at": time.time(),
-                "last_accessed": time.time(),
+                "output_event": output_event,
+                "lock": threading.Lock(),
+                "created_at": time.monotonic(),
+                "last_accessed": time.monotonic(),
                 "command": command
             }
-            
-            if command:
-                process.stdin.write(command + "\n")
-                process.stdin.flush()
-            
-            return True, f"Session {session_id} started"
+            ACTIVE_SESSIONS[session_id] = session
+            SESSION_CV.notify()
         
         except Exception as e:
             return False, f"Failed to start session: {str(e)}"
+    
+    if command:
+        try:
+            with session["lock"]:
+                process.stdin.write(command + "\n")
+                process.stdin.flush()
+        except Exception as e:
+            return False, f"Session {session_id} started but command failed: {str(e)}"
+    
+    return True, f"Session {session_id} started"
 
 def send_input(session_id: str, input_text: str) -> Tuple[bool, str]:
-    with SESSION_LOCK:
-        session = ACTIVE_SESSIONS.get(session_id)
-        if not session:
-            return False, f"Session {session_id} not found"
-        
+    # dict.get is atomic; SESSION_LOCK only guards inserts and deletes
+    session = ACTIVE_SESSIONS.get(session_id)
+    if not session:
+        return False, f"Session {session_id} not found"
+    
+    with session["lock"]:
         try:
             if session["process"].poll() is not None:
                 return False, f"Session {session_id} has terminated"
             
             session["process"].stdin.write(input_text + "\n")
             session["process"].stdin.flush()
-            session["last_accessed"] = time.time()
+            session["last_accessed"] = time.monotonic()
             
             return True, f"Input sent to session {session_id}"
         
@@ -2100,36 +2432,41 @@ def send_input(session_id: str, input_text: str) -> Tuple[bool, str]:
             return False, f"Failed to send input: {str(e)}"
 
 def read_output(session_id: str, timeout: int = 2) -> Tuple[bool, str]:
-    with SESSION_LOCK:
-        session = ACTIVE_SESSIONS.get(session_id)
-        if not session:
-            return False, f"Session {session_id} not found"
-        
-        session["last_accessed"] = time.time()
+    session = ACTIVE_SESSIONS.get(session_id)
+    if not session:
+        return False, f"Session {session_id} not found"
+    
+    session["last_accessed"] = time.monotonic()
     
     try:
+        output_queue = session["output_queue"]
+        output_event = session["output_event"]
         output_lines = []
         total_size = 0
-        deadline = time.time() + timeout
+        truncated = False
+        deadline = time.monotonic() + timeout
         
-        while time.time() < deadline:
-            try:
-                remaining = deadline - time.time()
-                if remaining <= 0:
-                    break
-                
-                stream_name, line = session["output_queue"].get(timeout=min(remaining, 0.1))
+        while True:
+            # clear before draining so a line appended mid-drain leaves the event set
+            output_event.clear()
+            while output_queue:
+                stream_name, line = output_queue.popleft()
                 output_lines.append(line.rstrip())
                 total_size += len(line)
-                
                 if total_size > OUTPUT_BUFFER_SIZE:
                     output_lines.append(f"[output truncated at {OUTPUT_BUFFER_SIZE} bytes]")
+                    truncated = True
                     break
+            if truncated:
+                break
             
-            except queue.Empty:
-                if output_lines:
-                    break
-                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # once output has started, return after a short lull instead of the full timeout
+            wait_for = min(remaining, 0.1) if output_lines else remaining
+            if not output_event.wait(timeout=wait_for) and output_lines:
+                break
         
         if not output_lines:
             return True, "[no output within timeout]"
@@ -2141,66 +2478,165 @@ def read_output(session_id: str, timeout: int = 2) -> Tuple[bool, str]:
 
 def close_session(session_id: str) -> Tuple[bool, str]:
     with SESSION_LOCK:
-        session = ACTIVE_SESSIONS.get(session_id)
-        if not session:
-            return False, f"Session {session_id} not found"
-        
-        try:
-            process = session["process"]
-            if process.poll() is None:
-                process.terminate()
-                try:
-                    process.wait(timeout=2)
-                except subprocess.TimeoutExpired:
-                    process.kill()
-                    process.wait()
-            
-            del ACTIVE_SESSIONS[session_id]
-            return True, f"Session {session_id} closed"
-        
-        except Exception as e:
-            return False, f"Failed to close session: {str(e)}"
+        session = ACTIVE_SESSIONS.pop(session_id, None)
+    if not session:
+        return False, f"Session {session_id} not found"
+    
+    # The popped session is owned by this call; terminate without the lock held.
+    try:
+        _terminate_process(session["process"])
+        return True, f"Session {session_id} closed"
+    except Exception as e:
+        return False, f"Failed to close session: {str(e)}"
 
 def list_sessions() -> Tuple[bool, str]:
-    with SESSION_LOCK:
-        if not ACTIVE_SESSIONS:
-            return True, "No active sessions"
-        
-        now = time.time()
-        lines = []
-        for sid, session in ACTIVE_SESSIONS.items():
-            age = int(now - session["created_at"])
-            idle = int(now - session["last_accessed"])
-            alive = "alive" if session["process"].poll() is None else "dead"
-            lines.append(f"{sid}: {alive}, age={age}s, idle={idle}s")
-        
-        return True, "\n".join(lines)
+    # snapshot without SESSION_LOCK so a slow close/cleanup never blocks listing
+    sessions = list(ACTIVE_SESSIONS.items())
+    if not sessions:
+        return True, "No active sessions"
+    
+    now = time.monotonic()
+    lines = []
+    for sid, session in sessions:
+        age = int(now - session["created_at"])
+        idle = int(now - session["last_accessed"])
+        alive = "alive" if session["process"].poll() is None else "dead"
+        lines.append(f"{sid}: {alive}, age={age}s, idle={idle}s")
+    
+    return True, "\n".join(lines)
+
+_PRIVATE_V4_NETWORKS = tuple(
+    (int(net.network_address), int(net.netmask))
+    for net in map(ipaddress.ip_network, (
+        "0.0.0.0/8", "10.0.0.0/8", "100.64.0.0/10", "127.0.0.0/8",
+        "169.254.0.0/16", "172.16.0.0/12", "192.168.0.0/16",
+        "224.0.0.0/4", "240.0.0.0/4",
+    ))
+)
+_PRIVATE_V6_NETWORKS = tuple(
+    (int(net.network_address), int(net.netmask))
+    for net in map(ipaddress.ip_network, (
+        "::/128", "::1/128", "fc00::/7", "fe80::/10", "ff00::/8",
+    ))
+)
+# IPv6 ranges whose low 32 bits address an IPv4 host: IPv4-compatible,
+# IPv4-translated and NAT64 (mapped, 6to4 and Teredo have ipaddress helpers)
+_V4_EMBEDDING_V6_NETWORKS = tuple(map(ipaddress.ip_network, (
+    "::/96", "::ffff:0:0:0/96", "64:ff9b::/96",
+)))
+DNS_CACHE_TTL = 60
+_DNS_CACHE: Dict[str, Tuple[float, tuple]] = {}
+_DNS_CACHE_LOCK = threading.Lock()
+
+def _resolve_host(hostname: str) -> tuple:
+    """Resolve hostname to its IP strings, caching answers for DNS_CACHE_TTL seconds."""
+    now = time.monotonic()
+    with _DNS_CACHE_LOCK:
+        entry = _DNS_CACHE.get(hostname)
+    if entry and entry[0] > now:
+        return entry[1]
+    infos = socket.getaddrinfo(hostname, None, type=socket.SOCK_STREAM)
+    addrs = tuple({info[4][0] for info in infos})
+    with _DNS_CACHE_LOCK:
+        if len(_DNS_CACHE) >= 256:
+            _DNS_CACHE.clear()
+        _DNS_CACHE[hostname] = (now + DNS_CACHE_TTL, addrs)
+    return addrs
+
+def _embedded_ipv4(ip: ipaddress.IPv6Address) -> Optional[ipaddress.IPv4Address]:
+    if ip.ipv4_mapped is not None:
+        return ip.ipv4_mapped
+    if ip.sixtofour is not None:
+        return ip.sixtofour
+    if ip.teredo is not None:
+        return ip.teredo[1]
+    if any(ip in net for net in _V4_EMBEDDING_V6_NETWORKS):
+        return ipaddress.IPv4Address(int(ip) & 0xFFFFFFFF)
+    return None
+
+def _addr_is_private(addr: str) -> bool:
+    ip = ipaddress.ip_address(addr.split('%', 1)[0])
+    if ip.version == 6:
+        # judge IPv6 forms that tunnel to an IPv4 host by that host
+        ip = _embedded_ipv4(ip) or ip
+    if (ip.is_private or ip.is_reserved or ip.is_loopback or ip.is_link_local
+            or ip.is_multicast or ip.is_unspecified
+            or (ip.version == 6 and ip.is_site_local)):
+        return True
+    value = int(ip)
+    table = _PRIVATE_V4_NETWORKS if ip.version == 4 else _PRIVATE_V6_NETWORKS
+    return any(value & mask == net for net, mask in table)
 
 def _is_private_ip(hostname: str) -> bool:
     try:
-        ip = socket.gethostbyname(hostname)
-        parts = ip.split('.')
-        if len(parts) != 4:
-            return True
-        
-        first = int(parts[0])
-        second = int(parts[1])
-        
-        if first == 127:
-            return True
-        if first == 10:
-            return True
-        if first == 172 and 16 <= second <= 31:
-            return True
-        if first == 192 and second == 168:
-            return True
-        if first == 169 and second == 254:
+        # IP literals need no DNS round trip
+        try:
+            return _addr_is_private(hostname)
+        except ValueError:
+            pass
+        addrs = _resolve_host(hostname)
+        if not addrs:
             return True
-        
-        return False
+        return any(_addr_is_private(addr) for addr in addrs)
     except Exception:
         return True
 
+def _get_http_session() -> requests.Session:
+    """Return this thread's pooled HTTP session, creating it on first use."""
+    session = getattr(_HTTP_LOCAL, "session", None)
+    if session is None:
+        session = requests.Session()
+        # retry refused connections and gateway errors, but not read timeouts,
+        # so a slow server still fails after one timeout window
+        retry = Retry(
+            total=2,
+            read=0,
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retry)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["User-Agent"] = HTTP_USER_AGENT
+        _HTTP_LOCAL.session = session
+        with _HTTP_SESSIONS_LOCK:
+            _HTTP_SESSIONS.append(session)
+    return session
+
+
+def _close_http_sessions() -> None:
+    with _HTTP_SESSIONS_LOCK:
+        sessions = list(_HTTP_SESSIONS)
+        _HTTP_SESSIONS.clear()
+    for session in sessions:
+        try:
+            session.close()
+        except Exception:
+            pass
+
+
+atexit.register(_close_http_sessions)
+
+
+_H2T_FEED_HOLDBACK = len("</' + 'script>") - 1
+
+
+def _silence_noscript(h2t, tag, attrs, start) -> Optional[bool]:
+    if tag != "noscript":
+        return None
+    # Only undo what an opening tag added: a stray </noscript> must not
+    # unsilence <script>/<style> content or drive quiet negative
+    depth = getattr(h2t, "_noscript_depth", 0)
+    if start:
+        h2t._noscript_depth = depth + 1
+        h2t.quiet += 1
+    elif depth > 0:
+        h2t._noscript_depth = depth - 1
+        h2t.quiet -= 1
+    return True
+
+
 def fetch_url(url: str, timeout: int = 10) -> Tuple[bool, str]:
     MAX_SIZE = 5 * 1024 * 1024
     
@@ -2213,42 +2649,46 @@ def fetch_url(url: str, timeout: int = 10) -> Tuple[bool, str]:
         if not parsed.netloc:
             return False, "Invalid URL: missing hostname"
         
-        hostname = parsed.netloc.split(':')[0]
+        # .hostname strips userinfo, port and IPv6 brackets, and lowercases
+        hostname = parsed.hostname
+        if not hostname:
+            return False, "Invalid URL: missing hostname"
         if _is_private_ip(hostname):
             return False, f"Access to private IP addresses is forbidden: {hostname}"
         
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (compatible; TriCode/1.0)'
-        }
-        
-        response = requests.get(url, headers=headers, timeout=timeout, stream=True)
-        response.raise_for_status()
-        
-        content_length = response.headers.get('Content-Length')
-        if content_length and int(content_length) > MAX_SIZE:
-            return False, f"Content too large: {content_length} bytes (max: {MAX_SIZE})"
-        
-        chunks = []
-        total_size = 0
-        for chunk in response.iter_content(chunk_size=8192):
-            total_size += len(chunk)
-            if total_size > MAX_SIZE:
-                return False, f"Content exceeded size limit during download (max: {MAX_SIZE} bytes)"
-            chunks.append(chunk)
-        
-        html_content = b''.join(chunks).decode(response.encoding or 'utf-8', errors='ignore')
-        
-        soup = BeautifulSoup(html_content, 'html.parser')
-        for script in soup(['script', 'style', 'noscript']):
-            script.decompose()
-        
         h2t = html2text.HTML2Text()
         h2t.ignore_links = False
         h2t.ignore_images = False
         h2t.ignore_emphasis = False
         h2t.body_width = 0
+        # html2text already silences <script>/<style>; extend that to <noscript>
+        h2t.tag_callback = _silence_noscript
+        
+        with _get_http_session().get(url, timeout=timeout, stream=True) as response:
+            response.raise_for_status()
+            
+            content_length = response.headers.get('Content-Length')
+            if content_length and int(content_length) > MAX_SIZE:
+                return False, f"Content too large: {content_length} bytes (max: {MAX_SIZE})"
+            
+            # decode and parse chunk by chunk; the page is never held whole
+            decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='ignore')
+            h2t.start = True
+            pending = ""
+            total_size = 0
+            for chunk in response.iter_content(chunk_size=8192):
+                total_size += len(chunk)
+                if total_size > MAX_SIZE:
+                    return False, f"Content exceeded size limit during download (max: {MAX_SIZE} bytes)"
+                text = pending + decoder.decode(chunk)
+                # hold back a tail so html2text's '</' + 'script>' rewrite never sees a split marker
+                cut = max(0, len(text) - _H2T_FEED_HOLDBACK)
+                h2t.feed(text[:cut])
+                pending = text[cut:]
+            h2t.feed(pending + decoder.decode(b'', final=True))
         
-        markdown = h2t.handle(str(soup))
+        h2t.feed("")
+        markdown = h2t.optwrap(h2t.finish())
         markdown = markdown.strip()
         
         if not markdown:
@@ -2265,6 +2705,47 @@ def fetch_url(url: str, timeout: int = 10) -> Tuple[bool, str]:
     except Exception as e:
         return False, f"Failed to fetch URL: {str(e)}"
 
+class _TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is free."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            # Jitter keeps concurrent callers from waking in lockstep.
+            time.sleep(wait + random.uniform(0.25, 0.75))
+
+
+_WEB_SEARCH_BUCKET = _TokenBucket(rate=1 / WEB_SEARCH_RATE_LIMIT, capacity=WEB_SEARCH_BURST)
+_DDGS_LOCAL = threading.local()
+
+
+def _get_ddgs() -> DDGS:
+    """Return this thread's DDGS client so cookies and connections persist."""
+    client = getattr(_DDGS_LOCAL, "client", None)
+    if client is None:
+        client = DDGS()
+        _DDGS_LOCAL.client = client
+    return client
+
+
+def _reset_ddgs() -> None:
+    _DDGS_LOCAL.client = None
+
+
 def _web_search_html_fallback(query: str, max_results: int = 5) -> Tuple[bool, str]:
     """Fallback DuckDuckGo HTML scraping when API lib misbehaves in bundled builds.
 
@@ -2273,8 +2754,8 @@ def _web_search_html_fallback(query: str, max_results: int = 5) -> Tuple[bool, s
     try:
         url = "https://html.duckduckgo.com/html/"
         params = {"q": query}
-        headers = {"User-Agent": "Mozilla/5.0 (compatible; TriCode/1.0)"}
-        resp = requests.get(url, params=params, headers=headers, timeout=10)
+        headers = {"User-Agent": random.choice(WEB_SEARCH_USER_AGENTS)}
+        resp = _get_http_session().get(url, params=params, headers=headers, timeout=10)
         resp.raise_for_status()
 
         soup = BeautifulSoup(resp.text, "html.parser")
@@ -2300,27 +2781,18 @@ def _web_search_html_fallback(query: str, max_results: int = 5) -> Tuple[bool, s
 
 
 def web_search(query: str, max_results: int = 5) -> Tuple[bool, str]:
-    global LAST_WEB_SEARCH_TIME
-    
     if max_results < 1:
         return False, "max_results must be at least 1"
     if max_results > 20:
         max_results = 20
     
-    elapsed = time.time() - LAST_WEB_SEARCH_TIME
-    if elapsed < WEB_SEARCH_RATE_LIMIT:
-        wait_time = WEB_SEARCH_RATE_LIMIT - elapsed
-        time.sleep(wait_time)
-    
     max_retries = 3
     base_delay = 2
     
     for attempt in range(max_retries):
+        _WEB_SEARCH_BUCKET.acquire()
         try:
-            with DDGS() as ddgs:
-                results = list(ddgs.text(query, max_results=max_results))
-            
-            LAST_WEB_SEARCH_TIME = time.time()
+            results = list(_get_ddgs().text(query, max_results=max_results))
             
             if not results:
                 return True, "No results found"
@@ -2343,6 +2815,7 @@ def web_search(query: str, max_results: int = 5) -> Tuple[bool, str]:
             return True, "\n".join(formatted)
             
         except Exception as e:
+            _reset_ddgs()
             error_str = str(e).lower()
             
             if 'ratelimit' in error_str or '429' in error_str or '202' in error_str:
@@ -2360,9 +2833,9 @@ def web_search(query: str, max_results: int = 5) -> Tuple[bool, str]:
                 # ddgs has thrown odd KeyError('text') in some bundled builds.
                 # Attempt a single HTML fallback on the first failure.
                 if attempt == 0:
+                    _WEB_SEARCH_BUCKET.acquire()
                     ok, res = _web_search_html_fallback(query, max_results)
                     if ok:
-                        LAST_WEB_SEARCH_TIME = time.time()
                         return True, res
                 return False, f"Search failed: {str(e)}"
     
@@ -2396,151 +2869,325 @@ def get_plan_reminder() -> str:
     
     return None
 
+def _fmt_search_context(arguments: dict) -> str:
+    pattern = arguments.get("pattern", "")
+    path = arguments.get("path", ".")
+    return f'SEARCH(pattern="{pattern}", path="{path}")'
+
+def _fmt_read_file(arguments: dict) -> str:
+    path = arguments.get("path", "")
+    s = arguments.get("start_line")
+    e = arguments.get("end_line")
+    mb = arguments.get("max_bytes")
+    meta = arguments.get("with_metadata", False)
+    parts = [f'"{path}"']
+    if s is not None:
+        parts.append(f'start={s}')
+        if e is not None:
+            parts.append(f'end={e}')
+    if mb is not None:
+        parts.append(f'max={mb}B')
+    if meta:
+        parts.append('meta')
+    return f'READ({", ".join(parts)})'
+
+def _fmt_create_file(arguments: dict) -> str:
+    path = arguments.get("path", "")
+    return f'CREATE("{path}")'
+
+def _fmt_edit_file(arguments: dict) -> str:
+    path = arguments.get("path", "")
+    mode = arguments.get("mode", "patch")
+    hunks = arguments.get("hunks", [])
+    if mode != "patch":
+        return f'EDIT("{path}", mode={mode})'
+    if hunks:
+        return f'EDIT("{path}", hunks={len(hunks)})'
+    return f'EDIT("{path}")'
+
+def _fmt_list_directory(arguments: dict) -> str:
+    path = arguments.get("path", ".")
+    return f'LIST("{path}")'
+
+def _fmt_search_symbol(arguments: dict) -> str:
+    symbol = arguments.get("symbol", "")
+    language = arguments.get("language")
+    kind = arguments.get("kind")
+    offset = arguments.get("offset")
+    qualified_name = arguments.get("qualified_name")
+    enclosing = arguments.get("enclosing")
+    parts = [f'"{symbol}"']
+    if language:
+        parts.append(f"lang={language}")
+    if kind:
+        parts.append(f"kind={kind}")
+    if offset:
+        parts.append(f"offset={offset}")
+    if qualified_name:
+        parts.append(f"q={qualified_name}")
+    if enclosing:
+        parts.append(f"enc={enclosing}")
+    return f'SYMBOL({", ".join(parts)})'
+
+def _fmt_list_symbols(arguments: dict) -> str:
+    path = arguments.get("path", ".")
+    language = arguments.get("language")
+    kind = arguments.get("kind")
+    max_results = arguments.get("max_results")
+    offset = arguments.get("offset")
+    parts = [f'"{path}"']
+    if language:
+        parts.append(f"lang={language}")
+    if kind:
+        parts.append(f"kind={kind}")
+    if max_results:
+        parts.append(f"max={max_results}")
+    if offset:
+        parts.append(f"offset={offset}")
+    return f'LIST SYMBOLS({", ".join(parts)})'
+
+def _fmt_search_references(arguments: dict) -> str:
+    definition = arguments.get("definition")
+    symbol = arguments.get("symbol")
+    mode = arguments.get("mode")
+    parts: list[str] = []
+    if definition:
+        path = definition.get("file", "")
+        line = definition.get("start_line")
+        if line is not None:
+            parts.append(f'def="{path}:{line}"')
+        else:
+            parts.append(f'def="{path}"')
+    elif symbol:
+        lang = symbol.get("language")
+        sym_name = symbol.get("name", "")
+        if lang:
+            parts.append(f'sym="{lang}:{sym_name}"')
+        else:
+            parts.append(f'sym="{sym_name}"')
+    if mode:
+        parts.append(f"mode={mode}")
+    return f'REFS({", ".join(parts)})'
+
+def _fmt_delete_file(arguments: dict) -> str:
+    path = arguments.get("path", "")
+    return f'DELETE FILE("{path}")'
+
+def _fmt_delete_path(arguments: dict) -> str:
+    path = arguments.get("path", "")
+    recursive = arguments.get("recursive", False)
+    suffix = ", recursive=True" if recursive else ""
+    return f'DELETE PATH("{path}"{suffix})'
+
+def _fmt_mkdir(arguments: dict) -> str:
+    path = arguments.get("path", "")
+    parents = arguments.get("parents", True)
+    exist_ok = arguments.get("exist_ok", False)
+    flags = []
+    if parents:
+        flags.append("parents=True")
+    if exist_ok:
+        flags.append("exist_ok=True")
+    flag_str = ", " + ", ".join(flags) if flags else ""
+    return f'MKDIR("{path}"{flag_str})'
+
+def _fmt_plan(arguments: dict) -> str:
+    action = arguments.get("action", "").upper()
+    return f'PLAN {action}'
+
+def _fmt_run_command(arguments: dict) -> str:
+    command = arguments.get("command", "")
+    return f'RUN({command})'
+
+def _fmt_start_session(arguments: dict) -> str:
+    command = arguments.get("command", "")
+    return f'START SESSION({command})'
+
+def _fmt_send_input(arguments: dict) -> str:
+    sid = arguments.get("session_id", "")
+    text = arguments.get("input_text", "")
+    return f'SEND TO SESSION({sid}, "{text}")'
+
+def _fmt_read_output(arguments: dict) -> str:
+    sid = arguments.get("session_id", "")
+    return f'READ SESSTION OUTPUT({sid})'
+
+def _fmt_close_session(arguments: dict) -> str:
+    sid = arguments.get("session_id", "")
+    return f'CLOSE SESSION({sid})'
+
+def _fmt_list_sessions(arguments: dict) -> str:
+    return 'LIST SESSIONS()'
+
+def _fmt_fetch_url(arguments: dict) -> str:
+    url = arguments.get("url", "")
+    return f'FETCH URL("{url}")'
+
+def _fmt_get_diff(arguments: dict) -> str:
+    diff_id = arguments.get("diff_id", "")
+    return f'GET DIFF({diff_id})'
+
+def _fmt_web_search(arguments: dict) -> str:
+    query = arguments.get("query", "")
+    max_results = arguments.get("max_results", 5)
+    return f'WEB SEARCH("{query}", max={max_results})'
+
+_TOOL_FORMATTERS = {
+    "search_context": _fmt_search_context,
+    "read_file": _fmt_read_file,
+    "create_file": _fmt_create_file,
+    "edit_file": _fmt_edit_file,
+    "list_directory": _fmt_list_directory,
+    "search_symbol": _fmt_search_symbol,
+    "list_symbols": _fmt_list_symbols,
+    "search_references": _fmt_search_references,
+    "delete_file": _fmt_delete_file,
+    "delete_path": _fmt_delete_path,
+    "mkdir": _fmt_mkdir,
+    "plan": _fmt_plan,
+    "run_command": _fmt_run_command,
+    "start_session": _fmt_start_session,
+    "send_input": _fmt_send_input,
+    "read_output": _fmt_read_output,
+    "close_session": _fmt_close_session,
+    "list_sessions": _fmt_list_sessions,
+    "fetch_url": _fmt_fetch_url,
+    "web_search": _fmt_web_search,
+    "get_diff": _fmt_get_diff,
+}
+
 def format_tool_call(name: str, arguments: dict) -> str:
-    if name == "search_context":
-        pattern = arguments.get("pattern", "")
-        path = arguments.get("path", ".")
-        return f'SEARCH(pattern="{pattern}", path="{path}")'
-    elif name == "read_file":
-        path = arguments.get("path", "")
-        s = arguments.get("start_line")
-        e = arguments.get("end_line")
-        mb = arguments.get("max_bytes")
-        meta = arguments.get("with_metadata", False)
-        parts = [f'"{path}"']
-        if s is not None:
-            parts.append(f'start={s}')
-            if e is not None:
-                parts.append(f'end={e}')
-        if mb is not None:
-            parts.append(f'max={mb}B')
-        if meta:
-            parts.append('meta')
-        return f'READ({", ".join(parts)})'
-    elif name == "create_file":
-        path = arguments.get("path", "")
-        return f'CREATE("{path}")'
-    elif name == "edit_file":
-        path = arguments.get("path", "")
-        mode = arguments.get("mode", "patch")
-        hunks = arguments.get("hunks", [])
-        if mode != "patch":
-            return f'EDIT("{path}", mode={mode})'
-        if hunks:
-            return f'EDIT("{path}", hunks={len(hunks)})'
-        return f'EDIT("{path}")'
-    elif name == "list_directory":
-        path = arguments.get("path", ".")
-        return f'LIST("{path}")'
-    elif name == "search_symbol":
-        symbol = arguments.get("symbol", "")
-        language = arguments.get("language")
-        kind = arguments.get("kind")
-        offset = arguments.get("offset")
-        qualified_name = arguments.get("qualified_name")
-        enclosing = arguments.get("enclosing")
-        parts = [f'"{symbol}"']
-        if language:
-            parts.append(f"lang={language}")
-        if kind:
-            parts.append(f"kind={kind}")
-        if offset:
-            parts.append(f"offset={offset}")
-        if qualified_name:
-            parts.append(f"q={qualified_name}")
-        if enclosing:
-            parts.append(f"enc={enclosing}")
-        return f'SYMBOL({", ".join(parts)})'
-    elif name == "list_symbols":
-        path = arguments.get("path", ".")
-        language = arguments.get("language")
-        kind = arguments.get("kind")
-        max_results = arguments.get("max_results")
-        offset = arguments.get("offset")
-        parts = [f'"{path}"']
-        if language:
-            parts.append(f"lang={language}")
-        if kind:
-            parts.append(f"kind={kind}")
-        if max_results:
-            parts.append(f"max={max_results}")
-        if offset:
-            parts.append(f"offset={offset}")
-        return f'LIST SYMBOLS({", ".join(parts)})'
-    elif name == "search_references":
-        definition = arguments.get("definition")
-        symbol = arguments.get("symbol")
-        mode = arguments.get("mode")
-        parts: list[str] = []
-        if definition:
-            path = definition.get("file", "")
-            line = definition.get("start_line")
-            if line is not None:
-                parts.append(f'def="{path}:{line}"')
-            else:
-                parts.append(f'def="{path}"')
-        elif symbol:
-            lang = symbol.get("language")
-            sym_name = symbol.get("name", "")
-            if lang:
-                parts.append(f'sym="{lang}:{sym_name}"')
-            else:
-                parts.append(f'sym="{sym_name}"')
-        if mode:
-            parts.append(f"mode={mode}")
-        return f'REFS({", ".join(parts)})'
-    elif name == "delete_file":
-        path = arguments.get("path", "")
-        return f'DELETE FILE("{path}")'
-    elif name == "delete_path":
-        path = arguments.get("path", "")
-        recursive = arguments.get("recursive", False)
-        suffix = ", recursive=True" if recursive else ""
-        return f'DELETE PATH("{path}"{suffix})'
-    elif name == "mkdir":
-        path = arguments.get("path", "")
-        parents = arguments.get("parents", True)
-        exist_ok = arguments.get("exist_ok", False)
-        flags = []
-        if parents:
-            flags.append("parents=True")
-        if exist_ok:
-            flags.append("exist_ok=True")
-        flag_str = ", " + ", ".join(flags) if flags else ""
-        return f'MKDIR("{path}"{flag_str})'
-    elif name == "plan":
-        action = arguments.get("action", "").upper()
-        return f'PLAN {action}'
-    elif name == "run_command":
-        command = arguments.get("command", "")
-        return f'RUN({command})'
-    elif name == "start_session":
-        command = arguments.get("command", "")
-        return f'START SESSION({command})'
-    elif name == "send_input":
-        sid = arguments.get("session_id", "")
-        text = arguments.get("input_text", "")
-        return f'SEND TO SESSION({sid}, "{text}")'
-    elif name == "read_output":
-        sid = arguments.get("session_id", "")
-        return f'READ SESSTION OUTPUT({sid})'
-    elif name == "close_session":
-        sid = arguments.get("session_id", "")
-        return f'CLOSE SESSION({sid})'
-    elif name == "list_sessions":
-        return 'LIST SESSIONS()'
-    elif name == "fetch_url":
-        url = arguments.get("url", "")
-        return f'FETCH URL("{url}")'
-    elif name == "web_search":
-        query = arguments.get("query", "")
-        max_results = arguments.get("max_results", 5)
-        return f'WEB SEARCH("{query}", max={max_results})'
-    else:
-        return f'{name.upper()}({arguments})'
+    fmt = _TOOL_FORMATTERS.get(name)
+    if fmt is not None:
+        return fmt(arguments)
+    return f'{name.upper()}({arguments})'
+
+_TOOL_REGISTRY = {
+    "search_context": (search_context, (
+        ("pattern", None),
+        ("path", "."),
+    )),
+    "search_symbol": (search_symbol, (
+        ("symbol", None),
+        ("path", "."),
+        ("max_results", None),
+        ("language", None),
+        ("kind", None),
+        ("offset", 0),
+        ("qualified_name", None),
+        ("enclosing", None),
+        ("signature_hint", None),
+        ("fields", None),
+    )),
+    "list_symbols": (list_symbols, (
+        ("path", "."),
+        ("max_results", None),
+        ("language", None),
+        ("kind", None),
+        ("offset", 0),
+        ("fields", None),
+    )),
+    "search_references": (search_references, (
+        ("definition", None),
+        ("symbol", None),
+        ("path", "."),
+        ("max_results", None),
+        ("include_tests", True),
+        ("include_third_party", True),
+        ("mode", "include_text"),
+        ("sort_by", "file"),
+        ("include_definition", False),
+        ("group_by", "none"),
+        ("symbol_id", None),
+        ("dedup", True),
+        ("files_prefix", None),
+        ("path_glob", None),
+    )),
+    "read_file": (read_file, (
+        ("path", None),
+        ("start_line", None),
+        ("end_line", None),
+        ("max_bytes", None),
+        ("with_metadata", False),
+    )),
+    "create_file": (create_file, (
+        ("path", None),
+        ("content", None),
+    )),
+    "edit_file": (edit_file, (
+        ("path", None),
+        ("hunks", None),
+        ("precondition", None),
+        ("dry_run", False),
+        ("mode", "patch"),
+        ("content", None),
+        ("include_diff", True),
+    )),
+    "list_directory": (list_directory, (
+        ("path", "."),
+        ("show_hidden", False),
+        ("recursive", False),
+    )),
+    "delete_file": (delete_file, (
+        ("path", None),
+    )),
+    "delete_path": (delete_path, (
+        ("path", None),
+        ("recursive", False),
+    )),
+    "mkdir": (mkdir, (
+        ("path", None),
+        ("parents", True),
+        ("exist_ok", False),
+    )),
+    "plan": (plan, (
+        ("action", None),
+        ("tasks", None),
+        ("task_id", None),
+        ("status", None),
+        ("reason", None),
+    )),
+    "run_command": (run_command, (
+        ("command", None),
+        ("timeout", 30),
+    )),
+    "start_session": (start_session, (
+        ("command", None),
+        ("shell", "/bin/bash"),
+    )),
+    "send_input": (send_input, (
+        ("session_id", None),
+        ("input_text", None),
+    )),
+    "read_output": (read_output, (
+        ("session_id", None),
+        ("timeout", 2),
+    )),
+    "close_session": (close_session, (
+        ("session_id", None),
+    )),
+    "list_sessions": (list_sessions, ()),
+    "fetch_url": (fetch_url, (
+        ("url", None),
+        ("timeout", 10),
+    )),
+    "web_search": (web_search, (
+        ("query", None),
+        ("max_results", 5),
+    )),
+    "get_diff": (get_diff, (
+        ("diff_id", None),
+        ("timeout", 10),
+    )),
+}
 
-def execute_tool(name: str, arguments: dict) -> Tuple[bool, str]:
-    global PLAN_DECISION_MADE, SIGNIFICANT_ACTIONS_COUNT
+def check_tool_call(name: str, arguments: dict) -> Optional[Tuple[bool, str]]:
+    """Plan gate, permission prompt and plan bookkeeping for one tool call.
+
+    Returns the result to report instead of running the tool, or None to go
+    ahead. Callers that answer from a cache still call this first.
+    """
+    global SIGNIFICANT_ACTIONS_COUNT
 
     if name != "plan" and not PLAN_DECISION_MADE and not BYPASS_PLAN_CHECK:
         return False, (
@@ -2563,140 +3210,17 @@ def execute_tool(name: str, arguments: dict) -> Tuple[bool, str]:
             denial_msg = error_msg or f"User denied {name} operation"
             return False, f"Denied: {denial_msg}"
     
-    significant_action_tools = ["read_file", "edit_file", "create_file", "delete_file", "delete_path", "mkdir", "run_command"]
-    if name in significant_action_tools and CURRENT_PLAN is not None:
-        SIGNIFICANT_ACTIONS_COUNT += 1
-    
-    if name == "search_context":
-        return search_context(
-            arguments.get("pattern"),
-            arguments.get("path", ".")
-        )
-    elif name == "search_symbol":
-        return search_symbol(
-            arguments.get("symbol"),
-            arguments.get("path", "."),
-            arguments.get("max_results"),
-            arguments.get("language"),
-            arguments.get("kind"),
-            arguments.get("offset", 0),
-            arguments.get("qualified_name"),
-            arguments.get("enclosing"),
-            arguments.get("signature_hint"),
-            arguments.get("fields"),
-        )
-    elif name == "list_symbols":
-        return list_symbols(
-            arguments.get("path", "."),
-            arguments.get("max_results"),
-            arguments.get("language"),
-            arguments.get("kind"),
-            arguments.get("offset", 0),
-            arguments.get("fields"),
-        )
-    elif name == "search_references":
-        return search_references(
-            definition=arguments.get("definition"),
-            symbol=arguments.get("symbol"),
-            path=arguments.get("path", "."),
-            max_results=arguments.get("max_results"),
-            include_tests=arguments.get("include_tests", True),
-            include_third_party=arguments.get("include_third_party", True),
-            mode=arguments.get("mode", "include_text"),
-            sort_by=arguments.get("sort_by", "file"),
-            include_definition=arguments.get("include_definition", False),
-            group_by=arguments.get("group_by", "none"),
-            symbol_id=arguments.get("symbol_id"),
-            dedup=arguments.get("dedup", True),
-            files_prefix=arguments.get("files_prefix"),
-            path_glob=arguments.get("path_glob"),
-        )
-    elif name == "read_file":
-        return read_file(
-            path=arguments.get("path"),
-            start_line=arguments.get("start_line"),
-            end_line=arguments.get("end_line"),
-            max_bytes=arguments.get("max_bytes"),
-            with_metadata=arguments.get("with_metadata", False)
-        )
-    elif name == "create_file":
-        return create_file(
-            arguments.get("path"),
-            arguments.get("content")
-        )
-    elif name == "edit_file":
-        return edit_file(
-            path=arguments.get("path"),
-            hunks=arguments.get("hunks"),
-            precondition=arguments.get("precondition"),
-            dry_run=arguments.get("dry_run", False),
-            mode=arguments.get("mode", "patch"),
-            content=arguments.get("content")
-        )
-    elif name == "list_directory":
-        return list_directory(
-            arguments.get("path", "."),
-            arguments.get("show_hidden", False),
-            arguments.get("recursive", False)
-        )
-    elif name == "delete_file":
-        return delete_file(
-            arguments.get("path")
-        )
-    elif name == "delete_path":
-        return delete_path(
-            arguments.get("path"),
-            arguments.get("recursive", False)
-        )
-    elif name == "mkdir":
-        return mkdir(
-            arguments.get("path"),
-            arguments.get("parents", True),
-            arguments.get("exist_ok", False)
-        )
-    elif name == "plan":
-        return plan(
-            arguments.get("action"),
-            arguments.get("tasks"),
-            arguments.get("task_id"),
-            arguments.get("status"),
-            arguments.get("reason")
-        )
-    elif name == "run_command":
-        return run_command(
-            arguments.get("command"),
-            arguments.get("timeout", 30)
-        )
-    elif name == "start_session":
-        return start_session(
-            arguments.get("command"),
-            arguments.get("shell", "/bin/bash")
-        )
-    elif name == "send_input":
-        return send_input(
-            arguments.get("session_id"),
-            arguments.get("input_text")
-        )
-    elif name == "read_output":
-        return read_output(
-            arguments.get("session_id"),
-            arguments.get("timeout", 2)
-        )
-    elif name == "close_session":
-        return close_session(
-            arguments.get("session_id")
-        )
-    elif name == "list_sessions":
-        return list_sessions()
-    elif name == "fetch_url":
-        return fetch_url(
-            arguments.get("url"),
-            arguments.get("timeout", 10)
-        )
-    elif name == "web_search":
-        return web_search(
-            arguments.get("query"),
-            arguments.get("max_results", 5)
-        )
-    else:
+    if name in SIGNIFICANT_ACTION_TOOLS and CURRENT_PLAN is not None:
+        with _PLAN_COUNTER_LOCK:
+            SIGNIFICANT_ACTIONS_COUNT += 1
+    return None
+
+def execute_tool(name: str, arguments: dict) -> Tuple[bool, str]:
+    blocked = check_tool_call(name, arguments)
+    if blocked is not None:
+        return blocked
+    entry = _TOOL_REGISTRY.get(name)
+    if entry is None:
         return False, f"Unknown tool: {name}"
+    func, specs = entry
+    return func(**{key: arguments.get(key, default) for key, default in specs})
@@ -1,14 +1,16 @@
-import uuid
+import secrets
 import json
 import asyncio
 import os
+import sys
 import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from datetime import datetime
-from typing import Iterator, Tuple, Union
-from openai import OpenAI
-from anthropic import Anthropic
-import tiktoken
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Iterator, Tuple, Union
 from textual.app import App, ComposeResult
 from textual.widgets import Header, Footer, TextArea, Static, ListView, ListItem, Label
 from textual.containers import Container, Vertical, Horizontal
@@ -16,7 +18,6 @@ from textual.binding import Binding
 from textual import events
 from textual.message import Message
 from textual.screen import ModalScreen
-from rich.markdown import Markdown
 from rich.text import Text
 from rich.panel import Panel
 from rich.markup import escape as rich_escape
@@ -26,7 +27,10 @@ import re
 from .tools import TOOLS_SCHEMA, execute_tool, format_tool_call, set_session_id, set_work_dir, restore_plan
 from . import tools as tools_module
 from .config import load_config, get_provider_config
-from .core import load_session, save_session, get_session_dir, filter_tools_schema, build_tools_description, load_agents_md, format_tool_result, call_llm_api, build_system_prompt
+if TYPE_CHECKING:
+    from openai import OpenAI
+    from anthropic import Anthropic
+from .core import create_llm_client, ToolLoopGuard, get_max_rounds, get_context_window, should_compact, compact_messages, json_loads, load_session, write_session, append_session_messages, list_session_files, read_session_file, get_session_dir, filter_tools_schema, build_tools_description, load_agents_md, format_tool_result, call_llm_api, build_system_prompt
 
 
 # TUI-only renderer: unified diff -> Rich Panel
@@ -134,6 +138,14 @@ def render_diff_rich(diff_text: str, max_lines: int = 200) -> Panel:
     return Panel(body, border_style="#888888")
 
 
+# Markdown longer than this is parsed on a worker thread
+MARKDOWN_THREAD_CHARS = 2000
+
+def _markdown(content: str):
+    # rich.markdown pulls in markdown-it; import it on first render
+    from rich.markdown import Markdown
+    return Markdown(content)
+
 class CollapsibleStatic(Static):
     """Static with collapsed preview for long content.
 
@@ -145,6 +157,9 @@ class CollapsibleStatic(Static):
         self._markdown = markdown
         self._preview_chars = max(200, preview_chars)
         self._collapsed = collapsed and len(self._full) > self._preview_chars
+        # streaming state: parsed paragraphs and the unfinished tail
+        self._stream_blocks: list = []
+        self._stream_tail = ""
         self._refresh()
 
     def toggle(self) -> None:
@@ -157,17 +172,64 @@ class CollapsibleStatic(Static):
             self._collapsed = bool(collapsed)
             self._refresh()
 
+    def append_text(self, chunk: str) -> None:
+        """Append streamed text, shown expanded until finish().
+
+        With markdown, each finished paragraph is parsed once and kept; only
+        the unfinished tail is shown as plain text.
+        """
+        self._full += chunk
+        if not self._markdown:
+            self.update(Text(self._full))
+            return
+        tail = self._stream_tail + chunk
+        start = search = 0
+        while True:
+            cut = tail.find("\n\n", search)
+            if cut < 0:
+                break
+            search = cut + 2
+            block = tail[start:cut]
+            if block.count("```") % 2:
+                # blank line inside a code fence; keep the fence in one block
+                continue
+            if block.strip():
+                if self._stream_blocks:
+                    self._stream_blocks.append(Text(""))
+                self._stream_blocks.append(_markdown(block))
+            start = search
+        self._stream_tail = tail[start:]
+        gap = [Text("")] if self._stream_blocks and self._stream_tail.strip() else []
+        self.update(Group(*self._stream_blocks, *gap, Text(self._stream_tail)))
+
+    def finish(self, content: str) -> None:
+        """Replace streamed text with the final content and render it normally."""
+        self._stream_blocks = []
+        self._stream_tail = ""
+        self._full = content or ""
+        self._collapsed = len(self._full) > self._preview_chars
+        self._refresh()
+
     def _refresh(self) -> None:
         if self._collapsed:
             preview = self._full[: self._preview_chars]
             suffix = "..." if len(self._full) > self._preview_chars else ""
             txt = Text(preview + suffix)
             self.update(txt)
+        elif self._markdown and len(self._full) > MARKDOWN_THREAD_CHARS and self.is_attached:
+            # show plain text until the parse is done so the loop stays responsive
+            self.update(Text(self._full))
+            self.run_worker(self._update_markdown(self._full), group="markdown", exclusive=True)
+        elif self._markdown:
+            self.update(_markdown(self._full))
         else:
-            if self._markdown:
-                self.update(Markdown(self._full))
-            else:
-                self.update(Text(self._full))
+            self.update(Text(self._full))
+
+    async def _update_markdown(self, content: str) -> None:
+        markdown = await asyncio.to_thread(_markdown, content)
+        # drop the result if the body was collapsed or replaced meanwhile
+        if not self._collapsed and content is self._full:
+            self.update(markdown)
 
 
 class LoadMoreItem(ListItem):
@@ -193,68 +255,122 @@ class MessageItem(ListItem):
         self.body = body
 
 
-def get_available_sessions() -> list:
-    session_dir = get_session_dir()
-    if not session_dir.exists():
+def _read_session_summary(item: tuple) -> Optional[tuple]:
+    # Pool worker for get_available_sessions: one log -> (summary, texts to tokenize)
+    session_file, mtime = item
+    try:
+        messages = read_session_file(session_file)
+        
+        mtime = datetime.fromtimestamp(mtime)
+        time_str = mtime.strftime("%Y-%m-%d %H:%M:%S")
+        
+        user_messages = [m for m in messages if m.get("role") == "user"]
+        msg_count = len(messages)
+        
+        first_prompt = "N/A"
+        if user_messages:
+            first_prompt = user_messages[0].get("content", "N/A")
+            if len(first_prompt) > 60:
+                first_prompt = first_prompt[:57] + "..."
+        
+        pieces = []
+        for message in messages:
+            role = message.get("role")
+            content = message.get("content", "")
+            
+            if content:
+                pieces.append(str(content))
+            
+            if role == "assistant":
+                tool_calls = message.get("tool_calls", [])
+                for tc in tool_calls:
+                    func_name = tc.get("function", {}).get("name", "")
+                    func_args = tc.get("function", {}).get("arguments", "")
+                    if func_name:
+                        pieces.append(func_name)
+                    if func_args:
+                        pieces.append(func_args)
+        
+        summary = {
+            "id": session_file.stem,
+            "time": time_str,
+            "msg_count": msg_count,
+            "first_prompt": first_prompt,
+            "total_tokens": 4 * msg_count
+        }
+        return summary, pieces
+    except Exception:
+        return None
+
+# Sessions summarized per worker step while the resume picker fills in
+SESSION_SUMMARY_BATCH = 8
+_SUMMARY_EXECUTOR = None
+
+def _get_summary_executor() -> ThreadPoolExecutor:
+    # Shared by every batch, so the picker doesn't spin up threads per step
+    global _SUMMARY_EXECUTOR
+    if _SUMMARY_EXECUTOR is None:
+        _SUMMARY_EXECUTOR = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4), thread_name_prefix="session-summary")
+    return _SUMMARY_EXECUTOR
+
+def summarize_sessions(session_files: list) -> list:
+    """Summarize (path, mtime) pairs; the result lines up with the input, None for unreadable logs."""
+    if not session_files:
         return []
-    
-    session_files = sorted(session_dir.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
-    sessions = []
+    # Read and parse the logs concurrently; map keeps the input order
+    results = list(_get_summary_executor().map(_read_session_summary, session_files))
+    readable = [r for r in results if r is not None]
     
     try:
-        encoding = tiktoken.get_encoding("cl100k_base")
+        encoding = _get_encoding(None)
     except Exception:
         encoding = None
-    
-    for session_file in session_files:
-        session_id = session_file.stem
+    if encoding is None:
+        for summary, _ in readable:
+            summary["total_tokens"] = 0
+        return [r[0] if r is not None else None for r in results]
+    
+    # Texts from every session, tokenized together in one call
+    pieces = []
+    spans = []
+    for _, session_pieces in readable:
+        spans.append((len(pieces), len(pieces) + len(session_pieces)))
+        pieces.extend(session_pieces)
+    if pieces:
         try:
-            with open(session_file, 'r', encoding='utf-8') as f:
-                messages = json.load(f)
-            
-            mtime = datetime.fromtimestamp(session_file.stat().st_mtime)
-            time_str = mtime.strftime("%Y-%m-%d %H:%M:%S")
-            
-            user_messages = [m for m in messages if m.get("role") == "user"]
-            msg_count = len(messages)
-            
-            first_prompt = "N/A"
-            if user_messages:
-                first_prompt = user_messages[0].get("content", "N/A")
-                if len(first_prompt) > 60:
-                    first_prompt = first_prompt[:57] + "..."
-            
-            total_tokens = 0
-            if encoding:
-                for message in messages:
-                    role = message.get("role")
-                    content = message.get("content", "")
-                    
-                    if content:
-                        total_tokens += len(encoding.encode(str(content)))
-                    total_tokens += 4
-                    
-                    if role == "assistant":
-                        tool_calls = message.get("tool_calls", [])
-                        for tc in tool_calls:
-                            func_name = tc.get("function", {}).get("name", "")
-                            func_args = tc.get("function", {}).get("arguments", "")
-                            if func_name:
-                                total_tokens += len(encoding.encode(func_name))
-                            if func_args:
-                                total_tokens += len(encoding.encode(func_args))
-            
-            sessions.append({
-                "id": session_id,
-                "time": time_str,
-                "msg_count": msg_count,
-                "first_prompt": first_prompt,
-                "total_tokens": total_tokens
-            })
+            lengths = [len(ids) for ids in encoding.encode_batch(pieces, num_threads=os.cpu_count() or 1)]
         except Exception:
-            pass
+            lengths = None
+        if lengths is not None:
+            for (summary, _), (start, end) in zip(readable, spans):
+                summary["total_tokens"] += sum(lengths[start:end])
     
-    return sessions
+    return [r[0] if r is not None else None for r in results]
+
+def get_available_sessions(lazy: bool = False) -> list:
+    """List saved sessions, newest first.
+
+    lazy=True only scans the directory: msg_count and total_tokens are None
+    and "file" holds the (path, mtime) pair to pass to summarize_sessions.
+    """
+    session_dir = get_session_dir()
+    if not session_dir.exists():
+        return []
+    
+    session_files = list_session_files()
+    if lazy:
+        return [
+            {
+                "id": path.stem,
+                "time": datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S"),
+                "msg_count": None,
+                "first_prompt": "",
+                "total_tokens": None,
+                "file": (path, mtime)
+            }
+            for path, mtime in session_files
+        ]
+    return [summary for summary in summarize_sessions(session_files) if summary is not None]
 
 
 class PermissionDialog(ModalScreen):
@@ -349,7 +465,7 @@ class PermissionDialog(ModalScreen):
                     diff_text = ""
                     if ok:
                         try:
-                            data = json.loads(res)
+                            data = json_loads(res)
                             diff_text = data.get("diff", "")
                         except Exception:
                             diff_text = ""
@@ -429,16 +545,44 @@ class SessionListScreen(ModalScreen):
     def __init__(self, sessions: list):
         super().__init__()
         self.sessions = sessions
+        # Row labels are built once here; compose only wraps them in widgets
+        self._rows = [self._format_row(session) for session in sessions]
+    
+    @staticmethod
+    def _format_row(session: dict) -> Text:
+        # "…" while a lazily listed session is still being summarized
+        msg_count = "…" if session["msg_count"] is None else session["msg_count"]
+        total_tokens = "…" if session["total_tokens"] is None else session["total_tokens"]
+        label_text = f"{session['id']} | {session['time']} | {msg_count} msgs | {total_tokens} tokens | {session['first_prompt']}"
+        # Use Text to bypass markup parsing for arbitrary session content
+        return Text(rich_escape(label_text))
+    
+    def on_mount(self) -> None:
+        if any(session["total_tokens"] is None for session in self.sessions):
+            self.run_worker(self._fill_summaries(), group="session-summaries", exclusive=True)
+    
+    async def _fill_summaries(self) -> None:
+        # Newest sessions first, a batch at a time, so the top rows fill in quickly
+        items = list(self.query_one(ListView).children)
+        for start in range(0, len(self.sessions), SESSION_SUMMARY_BATCH):
+            batch = self.sessions[start:start + SESSION_SUMMARY_BATCH]
+            summaries = await asyncio.to_thread(summarize_sessions, [session["file"] for session in batch])
+            for offset, (session, summary) in enumerate(zip(batch, summaries)):
+                if summary is None:
+                    session.update(msg_count="?", total_tokens="?", first_prompt="(unreadable)")
+                else:
+                    session.update(summary)
+                index = start + offset
+                if index < len(items):
+                    items[index].query_one(Label).update(self._format_row(session))
     
     def compose(self) -> ComposeResult:
         with Container(id="session_dialog"):
             yield Label("Resume Session (Enter to select, Esc to cancel)", id="session_title")
             
             with ListView():
-                for session in self.sessions:
-                    label_text = f"{session['id']} | {session['time']} | {session['msg_count']} msgs | {session['total_tokens']} tokens | {session['first_prompt']}"
-                    # Use Text to bypass markup parsing for arbitrary session content
-                    yield ListItem(Label(Text(rich_escape(label_text))))
+                for row in self._rows:
+                    yield ListItem(Label(row))
     
     def on_list_view_selected(self, event: ListView.Selected) -> None:
         selected_index = event.list_view.index
@@ -538,8 +682,7 @@ class CustomTextArea(TextArea):
                 app.action_cancel_request()
                 return
             
-            import time
-            current_time = time.time()
+            current_time = time.monotonic()
             time_since_last_esc = current_time - self.last_esc_time
             
             if time_since_last_esc < self.double_click_threshold:
@@ -557,19 +700,13 @@ class CustomTextArea(TextArea):
         elif event.key == "enter":
             cursor_row, cursor_col = self.cursor_location
             
-            if cursor_col > 0:
-                lines = self.text.split('\n')
-                if cursor_row < len(lines):
-                    current_line = lines[cursor_row]
-                    if cursor_col <= len(current_line) and current_line[cursor_col - 1:cursor_col] == '\\':
-                        event.prevent_default()
-                        event.stop()
-                        
-                        lines[cursor_row] = current_line[:cursor_col - 1] + current_line[cursor_col:]
-                        lines.insert(cursor_row + 1, '')
-                        self.text = '\n'.join(lines)
-                        self.move_cursor((cursor_row + 1, 0))
-                        return
+            # Backslash-enter: swap the backslash for a newline in one edit
+            if cursor_col > 0 and self.document.get_line(cursor_row)[cursor_col - 1:cursor_col] == '\\':
+                event.prevent_default()
+                event.stop()
+                self.replace("\n", (cursor_row, cursor_col - 1), (cursor_row, cursor_col))
+                self.move_cursor((cursor_row + 1, 0))
+                return
             
             event.prevent_default()
             event.stop()
@@ -578,8 +715,61 @@ class CustomTextArea(TextArea):
             super()._on_key(event)
 
 
+DELTA_FLUSH_INTERVAL = 0.033
+DELTA_FLUSH_BYTES = 4096
+# Streamed token counts are reported at most this often
+TOKEN_UPDATE_INTERVAL = 0.1
+
+def _tool_concurrency_limit() -> int:
+    # Consecutive read-only tool calls run in parallel on up to this many
+    # threads; TRICODE_TOOL_CONCURRENCY overrides it, and 1 turns it off
+    default = min(4, os.cpu_count() or 1)
+    try:
+        return max(1, int(os.environ.get("TRICODE_TOOL_CONCURRENCY", default)))
+    except ValueError:
+        return default
+
+TOOL_CONCURRENCY_LIMIT = _tool_concurrency_limit()
+_TOOL_EXECUTOR = None
+
+def _get_tool_executor() -> ThreadPoolExecutor:
+    global _TOOL_EXECUTOR
+    if _TOOL_EXECUTOR is None:
+        _TOOL_EXECUTOR = ThreadPoolExecutor(max_workers=TOOL_CONCURRENCY_LIMIT, thread_name_prefix="tool")
+    return _TOOL_EXECUTOR
+
+_SESSION_WRITER = None
+
+def _get_session_writer() -> ThreadPoolExecutor:
+    # One worker so queued saves hit the log in order
+    global _SESSION_WRITER
+    if _SESSION_WRITER is None:
+        _SESSION_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-save")
+    return _SESSION_WRITER
+
+def flush_session_writes() -> None:
+    """Block until every queued session save has been written."""
+    if _SESSION_WRITER is not None:
+        _SESSION_WRITER.submit(lambda: None).result()
+
+
+# Uncounted messages at or above this go through one encode_batch call
+BATCH_ENCODE_MIN = 16
+
+@lru_cache(maxsize=8)
+def _get_encoding(model: Optional[str]):
+    # Shared by every session and the session list; None means cl100k_base
+    import tiktoken
+    if model is None:
+        return tiktoken.get_encoding("cl100k_base")
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
 class AgentSession:
-    def __init__(self, session_id: str, messages: list, client: Union[OpenAI, Anthropic], model: str, provider: str = "openai", allowed_tools: list = None, debug: bool = False):
+    def __init__(self, session_id: str, messages: list, client: Union["OpenAI", "Anthropic"], model: str, provider: str = "openai", allowed_tools: list = None, debug: bool = False, max_rounds: int = None, on_warning: Optional[Callable[[str], None]] = None):
         self.session_id = session_id
         self.messages = messages
         self.client = client
@@ -590,28 +780,88 @@ class AgentSession:
         self.input_tokens = 0
         self.output_tokens = 0
         self.total_tokens = 0
-        
+        self._persisted_len = 0
+        # Only touched on the session-writer thread
+        self._save_failed = False
+        self.on_warning = on_warning
+        # (message, tokens) for the prefix of self.messages already counted
+        self._msg_token_cache = []
+        # (tool, canonical args) -> (success, result) for CACHEABLE_TOOLS
+        self._tool_cache = {}
+        self.max_rounds = max_rounds if max_rounds is not None else get_max_rounds()
+        self.context_window = get_context_window()
+        # Prompt size of the last round plus what it appended, for compaction
+        self._context_tokens = 0
+        self.encoding = _get_encoding(model)
+    
+    def save(self, full: bool = False) -> None:
+        """Queue messages added since the last save; full=True rewrites the log."""
+        messages = self.messages
+        start = self._persisted_len
+        if full or start <= 0 or start > len(messages):
+            start = 0
+        # Only the unsaved tail is copied; a rewrite needs the whole list
+        batch = messages[start:]
+        self._persisted_len = len(messages)
+        _get_session_writer().submit(self._write_session, batch, start == 0, len(messages))
+
+    def _write_session(self, batch: list, rewrite: bool, end: int) -> None:
+        # Session-writer thread. After a failed write the log may be missing
+        # earlier batches, so the next one rewrites everything up to its end.
+        if self._save_failed and not rewrite:
+            batch = self.messages[:end]
+            rewrite = True
         try:
-            self.encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            self.encoding = tiktoken.get_encoding("cl100k_base")
-    
-    def _count_messages_tokens(self) -> int:
-        num_tokens = 0
-        for message in self.messages:
-            num_tokens += 4
-            for key, value in message.items():
-                if key == "content" and value:
-                    num_tokens += len(self.encoding.encode(str(value)))
-                elif key == "name":
-                    num_tokens += len(self.encoding.encode(value))
-                    num_tokens -= 1
-        num_tokens += 2
+            if rewrite:
+                write_session(self.session_id, batch)
+            elif not (get_session_dir() / f"{self.session_id}.jsonl").exists():
+                raise FileNotFoundError(f"{self.session_id}.jsonl is missing")
+            else:
+                append_session_messages(self.session_id, batch)
+            self._save_failed = False
+        except Exception as e:
+            self._save_failed = True
+            if self.on_warning is not None:
+                self.on_warning(f"Failed to save session {self.session_id}: {e}")
+
+    def _message_tokens(self, message: dict, content_tokens: Optional[int] = None) -> int:
+        num_tokens = 4
+        for key, value in message.items():
+            if key == "content" and value:
+                num_tokens += content_tokens if content_tokens is not None else len(self.encoding.encode(str(value)))
+            elif key == "name":
+                num_tokens += len(self.encoding.encode(value))
+                num_tokens -= 1
         return num_tokens
+
+    def _count_messages_tokens(self) -> int:
+        # Only messages past the still-matching cached prefix get encoded;
+        # rewinds and compaction replace message objects, which ends the prefix.
+        cache = self._msg_token_cache
+        messages = self.messages
+        keep = 0
+        limit = min(len(cache), len(messages))
+        while keep < limit and cache[keep][0] is messages[keep]:
+            keep += 1
+        del cache[keep:]
+        new = messages[keep:]
+        if len(new) >= BATCH_ENCODE_MIN:
+            # e.g. a resumed history: one GIL-releasing call instead of one per message
+            texts = [str(m["content"]) if m.get("content") else "" for m in new]
+            encoded = self.encoding.encode_batch(texts, num_threads=os.cpu_count() or 1)
+            for message, ids in zip(new, encoded):
+                cache.append((message, self._message_tokens(message, len(ids))))
+        else:
+            for message in new:
+                cache.append((message, self._message_tokens(message)))
+        return sum(count for _, count in cache) + 2
     
     def calculate_history_tokens(self) -> tuple[int, int, int]:
         input_tokens = 0
         output_tokens = 0
+        # Gather every text first, then tokenize them in one encode_batch call
+        input_texts = []
+        output_texts = []
         
         for message in self.messages:
             role = message.get("role")
@@ -619,36 +869,115 @@ class AgentSession:
             
             if role in ["system", "user", "tool"]:
                 if content:
-                    input_tokens += len(self.encoding.encode(str(content)))
+                    input_texts.append(str(content))
                 input_tokens += 4
             elif role == "assistant":
                 if content:
-                    output_tokens += len(self.encoding.encode(str(content)))
+                    output_texts.append(str(content))
                 tool_calls = message.get("tool_calls", [])
                 for tc in tool_calls:
                     func_name = tc.get("function", {}).get("name", "")
                     func_args = tc.get("function", {}).get("arguments", "")
                     if func_name:
-                        output_tokens += len(self.encoding.encode(func_name))
+                        output_texts.append(func_name)
                     if func_args:
-                        output_tokens += len(self.encoding.encode(func_args))
+                        output_texts.append(func_args)
                 output_tokens += 4
         
+        texts = input_texts + output_texts
+        if texts:
+            lengths = [len(ids) for ids in self.encoding.encode_batch(texts, num_threads=os.cpu_count() or 1)]
+            input_tokens += sum(lengths[:len(input_texts)])
+            output_tokens += sum(lengths[len(input_texts):])
+        
         total_tokens = input_tokens + output_tokens
         return input_tokens, output_tokens, total_tokens
         
+    async def stream_message(self, content: str, cancel_check=None) -> AsyncIterator[dict]:
+        """Async view of send_message for the event loop.
+
+        The blocking LLM stream and tool calls stay on a worker thread. It
+        queues events and wakes the loop only when the loop has drained the
+        queue, so a burst of deltas costs one cross-thread wakeup, not one each.
+        """
+        loop = asyncio.get_running_loop()
+        pending = deque()
+        ready = asyncio.Event()
+        wake_lock = threading.Lock()
+        wake_scheduled = False
+        done = object()
+        stop = False
+
+        def push(item) -> None:
+            nonlocal wake_scheduled
+            pending.append(item)
+            with wake_lock:
+                if wake_scheduled:
+                    return
+                wake_scheduled = True
+            loop.call_soon_threadsafe(ready.set)
+
+        def pump() -> None:
+            events = self.send_message(content, cancel_check)
+            try:
+                for event in events:
+                    if stop:
+                        break
+                    push(event)
+            except BaseException as e:
+                push(e)
+            finally:
+                events.close()
+                push(done)
+
+        producer = asyncio.ensure_future(asyncio.to_thread(pump))
+        try:
+            while True:
+                await ready.wait()
+                ready.clear()
+                with wake_lock:
+                    wake_scheduled = False
+                while pending:
+                    item = pending.popleft()
+                    if item is done:
+                        return
+                    if isinstance(item, BaseException):
+                        raise item
+                    yield item
+        finally:
+            stop = True
+            await producer
+
     def send_message(self, content: str, cancel_check=None) -> Iterator[dict]:
         self.messages.append({"role": "user", "content": content})
         yield {"type": "user_message", "content": content}
         
+        # Files may have changed between turns
+        self._tool_cache.clear()
+        loop_guard = ToolLoopGuard()
         round_num = 0
         while True:
             if cancel_check and cancel_check():
                 return
             
             round_num += 1
+            if round_num > self.max_rounds:
+                yield {"type": "error", "content": f"Stopped after {self.max_rounds} rounds without a final answer"}
+                return
             yield {"type": "round", "number": round_num}
             
+            if should_compact(self._context_tokens, self.context_window):
+                compacted = compact_messages(self.client, self.model, self.provider, self.messages, debug=self.debug_mode)
+                if compacted is not None:
+                    removed = len(self.messages) - len(compacted) + 1
+                    self.messages = compacted
+                    self.save(full=True)
+                    yield {"type": "compacted", "content": f"Compacted {removed} earlier messages into a summary"}
+                self._context_tokens = 0
+            
+            # Re-encoding the history is CPU work independent of the reply, so
+            # overlap it with the request's time-to-first-byte.
+            prompt_tokens_future = _get_tool_executor().submit(self._count_messages_tokens)
             try:
                 stream = call_llm_api(
                     client=self.client,
@@ -664,14 +993,21 @@ class AgentSession:
                 return
             
             collected_content = ""
-            collected_tool_calls = []
-            tool_calls_map = {}
+            # Indexed by the streamed tool-call index; argument fragments are
+            # joined once at the end instead of concatenated per delta.
+            tool_calls_list = []
+            tool_args_parts = []
+            # Counted as the name/argument chunks arrive
+            tool_calls_tokens = 0
             
             round_start_input = self.input_tokens
             round_start_output = self.output_tokens
             
-            prompt_tokens = self._count_messages_tokens()
-            current_round_input = prompt_tokens
+            current_round_input = prompt_tokens_future.result()
+            # Running estimate from the deltas; usage replaces it when reported
+            current_round_output = 0
+            last_token_emit = 0.0
+            token_update_due = False
             
             for chunk in stream:
                 if cancel_check and cancel_check():
@@ -695,22 +1031,30 @@ class AgentSession:
                 
                 if delta.content:
                     collected_content += delta.content
-                    current_round_output = len(self.encoding.encode(collected_content))
+                    yield {"type": "assistant_delta", "content": delta.content}
+                    current_round_output += len(self.encoding.encode(delta.content))
                     self.input_tokens = round_start_input + current_round_input
                     self.output_tokens = round_start_output + current_round_output
                     self.total_tokens = self.input_tokens + self.output_tokens
-                    yield {
-                        "type": "token_update",
-                        "input_tokens": self.input_tokens,
-                        "output_tokens": self.output_tokens,
-                        "total_tokens": self.total_tokens
-                    }
+                    now = time.monotonic()
+                    token_update_due = now - last_token_emit < TOKEN_UPDATE_INTERVAL
+                    if not token_update_due:
+                        last_token_emit = now
+                        yield {
+                            "type": "token_update",
+                            "input_tokens": self.input_tokens,
+                            "output_tokens": self.output_tokens,
+                            "total_tokens": self.total_tokens
+                        }
                 
                 if delta.tool_calls:
                     for tc_delta in delta.tool_calls:
                         idx = tc_delta.index
-                        if idx not in tool_calls_map:
-                            tool_calls_map[idx] = {
+                        while len(tool_calls_list) <= idx:
+                            tool_calls_list.append(None)
+                            tool_args_parts.append([])
+                        if tool_calls_list[idx] is None:
+                            tool_calls_list[idx] = {
                                 "id": tc_delta.id or "",
                                 "type": "function",
                                 "function": {
@@ -720,17 +1064,36 @@ class AgentSession:
                             }
                         if tc_delta.function:
                             if tc_delta.function.name:
-                                tool_calls_map[idx]["function"]["name"] = tc_delta.function.name
+                                function = tool_calls_list[idx]["function"]
+                                # some providers repeat the full name; count it once
+                                if not function["name"]:
+                                    tool_calls_tokens += len(self.encoding.encode(tc_delta.function.name))
+                                function["name"] = tc_delta.function.name
                             if tc_delta.function.arguments:
-                                tool_calls_map[idx]["function"]["arguments"] += tc_delta.function.arguments
+                                tool_args_parts[idx].append(tc_delta.function.arguments)
+                                tool_calls_tokens += len(self.encoding.encode(tc_delta.function.arguments))
             
-            collected_tool_calls = [tool_calls_map[i] for i in sorted(tool_calls_map.keys())]
+            if token_update_due:
+                # report the counts the throttle held back
+                yield {
+                    "type": "token_update",
+                    "input_tokens": self.input_tokens,
+                    "output_tokens": self.output_tokens,
+                    "total_tokens": self.total_tokens
+                }
+            
+            collected_tool_calls = []
+            for tc, parts in zip(tool_calls_list, tool_args_parts):
+                if tc is not None:
+                    tc["function"]["arguments"] = "".join(parts)
+                    collected_tool_calls.append(tc)
+            self._context_tokens = current_round_input + self.output_tokens - round_start_output
             
             if not collected_tool_calls:
                 final_content = collected_content or "No response generated"
                 yield {"type": "assistant_message", "content": final_content}
                 self.messages.append({"role": "assistant", "content": final_content})
-                save_session(self.session_id, self.messages)
+                self.save()
                 return
             
             self.messages.append({
@@ -743,15 +1106,6 @@ class AgentSession:
             if collected_content:
                 yield {"type": "assistant_message", "content": collected_content}
             
-            tool_calls_tokens = 0
-            for tc in collected_tool_calls:
-                func_name = tc.get("function", {}).get("name", "")
-                func_args = tc.get("function", {}).get("arguments", "")
-                if func_name:
-                    tool_calls_tokens += len(self.encoding.encode(func_name))
-                if func_args:
-                    tool_calls_tokens += len(self.encoding.encode(func_args))
-            
             self.output_tokens += tool_calls_tokens
             self.total_tokens = self.input_tokens + self.output_tokens
             yield {
@@ -761,27 +1115,72 @@ class AgentSession:
                 "total_tokens": self.total_tokens
             }
             
-            tool_results = []
+            parsed_calls = []
+            for tool_call in collected_tool_calls:
+                func_name = tool_call["function"]["name"]
+                try:
+                    func_args = json_loads(tool_call["function"]["arguments"])
+                except json.JSONDecodeError:
+                    func_args = {}
+                cache_key = None
+                if func_name in tools_module.CACHEABLE_TOOLS:
+                    cache_key = (func_name, json.dumps(func_args, sort_keys=True, ensure_ascii=False, default=str))
+                parsed_calls.append((tool_call, func_name, func_args, cache_key))
+
+            # Tool messages are built (and counted) as results arrive, then
+            # added to the history in one step.
+            tool_messages = []
+            tool_messages_tokens = 0
+            # Futures for runs of read-only calls submitted ahead of their turn;
+            # any other tool is a barrier, so results still land in call order.
+            pending = {}
             try:
-                for idx, tool_call in enumerate(collected_tool_calls):
+                for idx, (tool_call, func_name, func_args, cache_key) in enumerate(parsed_calls):
                     if cancel_check and cancel_check():
                         return
 
-                    func_name = tool_call["function"]["name"]
-                    try:
-                        func_args = json.loads(tool_call["function"]["arguments"])
-                    except json.JSONDecodeError:
-                        func_args = {}
-
                     formatted_call = format_tool_call(func_name, func_args)
                     yield {"type": "tool_call", "name": func_name, "args": func_args, "formatted": formatted_call}
 
-                    success, result = execute_tool(func_name, func_args)
+                    if TOOL_CONCURRENCY_LIMIT > 1 and idx not in pending and func_name in tools_module.PARALLEL_SAFE_TOOLS:
+                        executor = _get_tool_executor()
+                        j = idx
+                        submitted = set()
+                        while j < len(parsed_calls) and parsed_calls[j][1] in tools_module.PARALLEL_SAFE_TOOLS:
+                            key = parsed_calls[j][3]
+                            # a repeat of an earlier call in the run is answered from the cache
+                            if key not in self._tool_cache and (key is None or key not in submitted):
+                                pending[j] = executor.submit(execute_tool, parsed_calls[j][1], parsed_calls[j][2])
+                                submitted.add(key)
+                            j += 1
+
+                    future = pending.pop(idx, None)
+                    if future is not None:
+                        try:
+                            success, result = future.result()
+                        except Exception as e:
+                            success, result = False, f"Tool execution failed: {str(e)}"
+                    elif cache_key in self._tool_cache:
+                        # Skips the tool itself, not the plan gate and counters
+                        blocked = tools_module.check_tool_call(func_name, func_args)
+                        success, result = blocked if blocked is not None else self._tool_cache[cache_key]
+                    else:
+                        success, result = execute_tool(func_name, func_args)
+                    if cache_key is not None:
+                        if success:
+                            self._tool_cache[cache_key] = (success, result)
+                    elif func_name not in tools_module.PARALLEL_SAFE_TOOLS and func_name != "plan":
+                        # Anything that may touch files or processes invalidates reads
+                        self._tool_cache.clear()
+                    notice = loop_guard.observe(func_name, func_args, result)
+                    if notice:
+                        result = f"{result}\n\n{notice}"
 
                     formatted_result = format_tool_result(func_name, success, result, func_args)
                     yield {"type": "tool_result", "name": func_name, "success": success, "result": result, "formatted": formatted_result}
 
-                    tool_results.append({"tool_call_id": tool_call["id"], "content": result})
+                    tool_messages.append({"role": "tool", "tool_call_id": tool_call["id"], "content": result})
+                    tool_messages_tokens += len(self.encoding.encode(str(result))) + 4
             except tools_module.PermissionDeniedTerminate as e:
                 # User denied a destructive action: we must still emit tool_results
                 # for ALL tool_use blocks in this assistant message to keep the
@@ -789,7 +1188,7 @@ class AgentSession:
                 denial_text = str(e) or "Operation denied by user"
                 # Include current and remaining tool calls that didn't get results
                 # Determine how many results have already been added; complete the rest
-                already = {tr["tool_call_id"] for tr in tool_results}
+                already = {m["tool_call_id"] for m in tool_messages}
                 for tc in collected_tool_calls:
                     if tc["id"] in already:
                         continue
@@ -799,24 +1198,17 @@ class AgentSession:
                         fn = tc.get("function", {}).get("name", "")
                         fa = tc.get("function", {}).get("arguments", "{}")
                         try:
-                            fa_parsed = json.loads(fa)
+                            fa_parsed = json_loads(fa)
                         except Exception:
                             fa_parsed = {}
                         formatted = format_tool_result(fn or "unknown", False, denial_result, fa_parsed)
                         yield {"type": "tool_result", "name": fn or "unknown", "success": False, "result": denial_result, "formatted": formatted, "args": fa_parsed}
                     except Exception:
                         pass
-                    tool_results.append({"tool_call_id": tc["id"], "content": denial_result})
+                    tool_messages.append({"role": "tool", "tool_call_id": tc["id"], "content": denial_result})
+                    tool_messages_tokens += len(self.encoding.encode(denial_result)) + 4
                 # After producing tool results for all tool_use, append them and stop this round
-                tool_messages_tokens = 0
-                for tool_result in tool_results:
-                    self.messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_result["tool_call_id"],
-                        "content": tool_result["content"]
-                    })
-                    tool_messages_tokens += len(self.encoding.encode(str(tool_result["content"])))
-                    tool_messages_tokens += 4
+                self.messages.extend(tool_messages)
                 self.input_tokens += tool_messages_tokens
                 self.total_tokens = self.input_tokens + self.output_tokens
                 yield {
@@ -825,23 +1217,15 @@ class AgentSession:
                     "output_tokens": self.output_tokens,
                     "total_tokens": self.total_tokens
                 }
-                save_session(self.session_id, self.messages)
+                self.save()
                 # Notify UI and stop processing further
                 yield {"type": "denied_request", "content": denial_text}
                 return
             
-            tool_messages_tokens = 0
-            for tool_result in tool_results:
-                self.messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_result["tool_call_id"],
-                    "content": tool_result["content"]
-                })
-                tool_messages_tokens += len(self.encoding.encode(str(tool_result["content"])))
-                tool_messages_tokens += 4
-            
+            self.messages.extend(tool_messages)
             self.input_tokens += tool_messages_tokens
             self.total_tokens = self.input_tokens + self.output_tokens
+            self._context_tokens += tool_calls_tokens + tool_messages_tokens
             yield {
                 "type": "token_update",
                 "input_tokens": self.input_tokens,
@@ -850,94 +1234,11 @@ class AgentSession:
             }
             # Content already shown before tools when present.
 
-            save_session(self.session_id, self.messages)
+            self.save()
 
 
 class TricodeCLI(App):
-    CSS = """
-    Screen {
-        layout: vertical;
-        background: #2b2420;
-    }
-    
-    #output_container {
-        height: 1fr;
-        border: solid #ff8c00;
-        background: #3a3228;
-    }
-    
-    #output {
-        height: 100%;
-        background: #3a3228;
-        color: #fdf5e6;
-        padding: 0;
-    }
-
-    #output > ListItem {
-        height: auto;
-        min-height: 1;
-        padding: 0 1;
-        margin: 0;
-    }
-
-    /* Hide highlight visuals for message items to appear unselectable */
-    #output > ListItem.msg-item.-highlight {
-        background: transparent;
-        color: #fdf5e6;
-    }
-    #output:focus > ListItem.msg-item.-highlight {
-        background: transparent;
-        color: #fdf5e6;
-    }
-
-    #output > ListItem > Vertical {
-        height: auto;
-        padding: 0;
-        margin: 0;
-        content-align: left top;
-    }
-
-    #output > ListItem Static {
-        height: auto;
-        padding: 0;
-        margin: 0;
-    }
-    
-    #stats_bar {
-        height: 1;
-        background: #2b2420;
-    }
-    
-    #loading_status {
-        width: 1fr;
-        height: 1;
-        background: #2b2420;
-        color: #ffa500;
-        text-align: left;
-        padding-left: 1;
-    }
-    
-    #token_stats {
-        width: auto;
-        height: 1;
-        background: #2b2420;
-        color: #ffa500;
-        text-align: right;
-        padding-right: 1;
-    }
-    
-    #input_container {
-        height: 5;
-        border: solid #ffa500;
-        background: #3a3228;
-    }
-    
-    #input {
-        height: 100%;
-        background: #3a3228;
-        color: #fdf5e6;
-    }
-    """
+    CSS_PATH = "tui.tcss"
     
     BINDINGS = [
         Binding("ctrl+c", "quit", "Quit"),
@@ -964,6 +1265,24 @@ class TricodeCLI(App):
         self.animation_timer = None
         self._token_last_update_ts: float = 0.0
         self._token_pending: Optional[Tuple[int, int, int]] = None
+        self._token_flush_timer = None
+        self._streaming_body: Optional[CollapsibleStatic] = None
+        self._delta_buffer: list = []
+        self._delta_buffered: int = 0
+        self._delta_flush_timer = None
+        self._append_layout_pending: bool = False
+        # Agent event type -> handler; unknown types are ignored
+        self._event_handlers = {
+            "token_update": self._on_token_update,
+            "tool_call": self._on_tool_call,
+            "tool_result": self._on_tool_result,
+            "assistant_delta": self._on_assistant_delta,
+            "assistant_message": self._on_assistant_message,
+            "error": self._on_error,
+            "compacted": self._on_compacted,
+            "cancelled": self._on_cancelled,
+            "denied_request": self._on_denied_request,
+        }
         self.history_window_size: int = int(os.getenv("TRICODE_TUI_WINDOW", "60"))
         self.history_render_from: int = 0
         # visible window tuning for auto-render
@@ -987,36 +1306,18 @@ class TricodeCLI(App):
         self.provider = provider_config["provider"]
         self.model = provider_config["model"]
         
-        if self.provider == "anthropic":
-            self.client = Anthropic(api_key=api_key, base_url=base_url)
-        else:
-            self.client = OpenAI(api_key=api_key, base_url=base_url)
+        self.client = create_llm_client(self.provider, api_key, base_url)
         
+        # A resumed session is loaded in on_mount, off the event loop, so the
+        # UI paints before the log is read; self.session stays None until then.
+        self._pending_resume_id = resume_session_id
         if resume_session_id:
-            try:
-                messages = load_session(resume_session_id)
-                self.session_id = resume_session_id
-                set_session_id(self.session_id)
-                restore_plan(self.session_id)
-                self.session = AgentSession(self.session_id, messages, self.client, self.model, self.provider, allowed_tools, self.debug_mode)
-                self.message_history = [msg.get("content") for msg in messages if msg.get("role") == "user"]
-                self.history_index = -1
-            except Exception as e:
-                self.session_id = str(uuid.uuid4())[:8]
-                set_session_id(self.session_id)
-                self.session = AgentSession(
-                    self.session_id, 
-                    self._create_initial_messages(), 
-                    self.client, 
-                    self.model, 
-                    self.provider,
-                    allowed_tools,
-                    self.debug_mode
-                )
-                self.message_history = []
-                self.history_index = -1
+            self.session_id = resume_session_id
+            self.session = None
+            self.message_history = []
+            self.history_index = -1
         else:
-            self.session_id = str(uuid.uuid4())[:8]
+            self.session_id = secrets.token_hex(4)
             set_session_id(self.session_id)
             self.session = AgentSession(
                 self.session_id, 
@@ -1025,11 +1326,16 @@ class TricodeCLI(App):
                 self.model, 
                 self.provider,
                 allowed_tools,
-                self.debug_mode
+                self.debug_mode,
+                on_warning=self._notify_warning
             )
             self.message_history = []
             self.history_index = -1
     
+    def _notify_warning(self, message: str) -> None:
+        # App.notify is thread-safe, so the session writer can call this directly
+        self.notify(message, severity="warning", markup=False)
+
     def _create_initial_messages(self) -> list:
         system_prompt = build_system_prompt(self.allowed_tools, self.override_system_prompt)
         return [{"role": "system", "content": system_prompt}]
@@ -1050,11 +1356,64 @@ class TricodeCLI(App):
         yield Footer()
     
     def on_mount(self) -> None:
-        lst = self.query_one("#output", ListView)
+        # The layout is static, so resolve the hot widgets once
+        self._output = self.query_one("#output", ListView)
+        self._input = self.query_one("#input", CustomTextArea)
+        self._loading_status = self.query_one("#loading_status", Static)
+        self._token_stats = self.query_one("#token_stats", Static)
         self._append_info_line("[bold #ff8c00]Tricode TUI Mode[/bold #ff8c00]")
+        if self._pending_resume_id:
+            self._append_info_line(f"[dim]Loading session {self._pending_resume_id}...[/dim]")
+            self.run_worker(self._resume_on_mount(self._pending_resume_id), exclusive=False)
+        else:
+            self._append_info_line(f"Session ID: {self.session_id}")
+            self._append_info_line("[dim]Press Enter to send, backslash+Enter for newline[/dim]")
+        self._input.focus()
+
+    async def _resume_on_mount(self, session_id: str) -> None:
+        self._pending_resume_id = None
+        if not await self._resume_session(session_id):
+            await self.action_new_session()
+            self._append_info_line(f"[bold red]Could not resume session {rich_escape(session_id)}; started a new one[/bold red]")
+
+    def _build_resumed_session(self, session_id: str) -> AgentSession:
+        # Runs on a worker thread: disk reads and tokenizing the history
+        flush_session_writes()
+        messages = load_session(session_id)
+        session = AgentSession(session_id, messages, self.client, self.model, self.provider, self.allowed_tools, self.debug_mode, on_warning=self._notify_warning)
+        session.input_tokens, session.output_tokens, session.total_tokens = session.calculate_history_tokens()
+        session._count_messages_tokens()  # warm the per-message cache
+        restore_plan(session_id)
+        return session
+
+    async def _resume_session(self, session_id: str) -> bool:
+        """Load a saved session off the event loop and show it; False on failure."""
+        try:
+            session = await asyncio.to_thread(self._build_resumed_session, session_id)
+        except Exception as e:
+            self._append_info_line("[bold red]Failed to resume session: " + rich_escape(str(e)) + "[/bold red]")
+            return False
+        
+        self.session_id = session_id
+        set_session_id(self.session_id)
+        self.session = session
+        messages = session.messages
+        
+        self.message_history = [msg.get("content") for msg in messages if msg.get("role") == "user"]
+        self.history_index = -1
+        
+        start_idx = max(0, len(messages) - self.history_window_size)
+        self._rebuild_from_messages(start_idx)
+        self._append_info_line(f"[bold #ff8c00]Session Resumed[/bold #ff8c00] [dim]({len(messages)} messages)[/dim]")
         self._append_info_line(f"Session ID: {self.session_id}")
         self._append_info_line("[dim]Press Enter to send, backslash+Enter for newline[/dim]")
-        self.query_one("#input", CustomTextArea).focus()
+        
+        token_text = f"↑ {session.input_tokens} tokens  ↓ {session.output_tokens} tokens  total: {session.total_tokens} tokens"
+        self._token_pending = None
+        self._token_stats.update(token_text)
+        
+        self._input.focus()
+        return True
     def _ask_permission_async(self, tool_name: str, arguments: dict) -> Tuple[bool, bool, str]:
         import threading
         result_holder = {'result': None}
@@ -1081,8 +1440,7 @@ class TricodeCLI(App):
         dots = '.' * self.dots_count
         loading_text = f"{spinner} Running{dots}"
         
-        loading_widget = self.query_one("#loading_status", Static)
-        loading_widget.update(loading_text)
+        self._loading_status.update(loading_text)
         
         self.spinner_index = (self.spinner_index + 1) % len(self.spinner_chars)
         self.dots_count = (self.dots_count % 3) + 1
@@ -1097,8 +1455,7 @@ class TricodeCLI(App):
         if self.animation_timer:
             self.animation_timer.stop()
             self.animation_timer = None
-        loading_widget = self.query_one("#loading_status", Static)
-        loading_widget.update("")
+        self._loading_status.update("")
         self.spinner_index = 0
         self.dots_count = 1
 
@@ -1106,11 +1463,8 @@ class TricodeCLI(App):
         await self._send_message()
 
     # Output helpers
-    def _output_view(self) -> ListView:
-        return self.query_one("#output", ListView)
-
     def _scroll_to_end(self) -> None:
-        lst = self._output_view()
+        lst = self._output
         try:
             if hasattr(lst, "action_scroll_end"):
                 lst.action_scroll_end()
@@ -1120,11 +1474,18 @@ class TricodeCLI(App):
             pass
 
     def _append_item(self, item: ListItem) -> None:
-        lst = self._output_view()
+        lst = self._output
         try:
             lst.append(item)
         except Exception:
             lst.mount(item)
+        # a tool batch appends many items at once; scroll and re-window once per refresh
+        if not self._append_layout_pending:
+            self._append_layout_pending = True
+            self.call_after_refresh(self._after_append)
+
+    def _after_append(self) -> None:
+        self._append_layout_pending = False
         self._scroll_to_end()
         self._update_render_window()
 
@@ -1136,9 +1497,42 @@ class TricodeCLI(App):
         self._append_item(MessageItem("You:", "[bold #ffa500]", body))
 
     def _append_agent_message(self, content: str) -> None:
+        body = self._streaming_body
+        if body is not None:
+            # the reply was already streamed in; render it as markdown in place
+            self._streaming_body = None
+            body.finish(content)
+            return
         body = CollapsibleStatic(content, markdown=True, collapsed=True)
         self._append_item(MessageItem("Agent:", "[bold #ff8c00]", body))
 
+    def _append_agent_delta(self, chunk: str) -> None:
+        # Deltas are coalesced and painted at most once per DELTA_FLUSH_INTERVAL,
+        # or straight away once DELTA_FLUSH_BYTES are waiting.
+        self._delta_buffer.append(chunk)
+        self._delta_buffered += len(chunk)
+        if self._delta_buffered >= DELTA_FLUSH_BYTES:
+            self._flush_agent_delta()
+        elif self._delta_flush_timer is None:
+            self._delta_flush_timer = self.set_timer(DELTA_FLUSH_INTERVAL, self._flush_agent_delta)
+
+    def _flush_agent_delta(self) -> None:
+        if self._delta_flush_timer is not None:
+            self._delta_flush_timer.stop()
+            self._delta_flush_timer = None
+        if not self._delta_buffer:
+            return
+        text = "".join(self._delta_buffer)
+        self._delta_buffer.clear()
+        self._delta_buffered = 0
+        body = self._streaming_body
+        if body is None:
+            body = CollapsibleStatic("", markdown=True, collapsed=False)
+            self._streaming_body = body
+            self._append_item(MessageItem("Agent:", "[bold #ff8c00]", body))
+        body.append_text(text)
+        self._scroll_to_end()
+
     def _append_tool_call(self, formatted: str) -> None:
         text = Text.from_markup(f"[#2b2420 on #ffb347] {rich_escape(str(formatted))} [/]")
         self._append_item(ListItem(Static(text)))
@@ -1160,7 +1554,7 @@ class TricodeCLI(App):
         if name == "edit_file":
             diff_text = ""
             try:
-                data = json.loads(result)
+                data = json_loads(result)
                 diff_text = data.get("diff", "")
             except Exception:
                 diff_text = ""
@@ -1170,7 +1564,7 @@ class TricodeCLI(App):
         self._append_tool_result_generic(formatted, success)
 
     def _clear_output(self) -> None:
-        lst = self._output_view()
+        lst = self._output
         for child in list(lst.children):
             try:
                 child.remove()
@@ -1178,13 +1572,24 @@ class TricodeCLI(App):
                 pass
 
     def _token_update_throttled(self, input_tokens: int, output_tokens: int, total_tokens: int) -> None:
-        now = time.time()
         self._token_pending = (input_tokens, output_tokens, total_tokens)
-        if now - self._token_last_update_ts >= 0.2:
-            self._token_last_update_ts = now
-            it, ot, tt = self._token_pending
-            token_stats = self.query_one("#token_stats", Static)
-            token_stats.update(f"↑ {it} tokens  ↓ {ot} tokens  total: {tt} tokens")
+        wait = 0.2 - (time.monotonic() - self._token_last_update_ts)
+        if wait <= 0:
+            self._flush_token_stats()
+        elif self._token_flush_timer is None:
+            # trailing update so the last counts are never dropped
+            self._token_flush_timer = self.set_timer(wait, self._flush_token_stats)
+
+    def _flush_token_stats(self) -> None:
+        if self._token_flush_timer is not None:
+            self._token_flush_timer.stop()
+            self._token_flush_timer = None
+        if self._token_pending is None:
+            return
+        self._token_last_update_ts = time.monotonic()
+        it, ot, tt = self._token_pending
+        self._token_pending = None
+        self._token_stats.update(f"↑ {it} tokens  ↓ {ot} tokens  total: {tt} tokens")
 
     def _rebuild_from_messages(self, start_index: int) -> None:
         self.history_render_from = max(0, start_index)
@@ -1211,7 +1616,7 @@ class TricodeCLI(App):
                     for tc in tool_calls:
                         func_name = tc.get("function", {}).get("name", "unknown")
                         try:
-                            func_args = json.loads(tc.get("function", {}).get("arguments", "{}"))
+                            func_args = json_loads(tc.get("function", {}).get("arguments", "{}"))
                         except json.JSONDecodeError:
                             func_args = {}
                         formatted_call = format_tool_call(func_name, func_args)
@@ -1229,7 +1634,7 @@ class TricodeCLI(App):
                 func_name, func_args = (func_info if isinstance(func_info, tuple) else (func_info, {})) if func_info else (None, {})
                 if func_name == "edit_file":
                     try:
-                        data = json.loads(content)
+                        data = json_loads(content)
                         diff_text = data.get("diff", "")
                     except Exception:
                         diff_text = ""
@@ -1251,7 +1656,7 @@ class TricodeCLI(App):
                     self._append_agent_message(pending_assistant_content)
                     pending_assistant_content = None
         self._append_info_line("[dim]--- History loaded ---[/dim]")
-        self.query_one("#input", CustomTextArea).focus()
+        self._input.focus()
         self._update_render_window()
 
     def action_load_more_history(self) -> None:
@@ -1274,7 +1679,7 @@ class TricodeCLI(App):
             return
 
     def _update_render_window(self, center_index: Optional[int] = None) -> None:
-        lst = self._output_view()
+        lst = self._output
         try:
             count = len(lst.children)
         except Exception:
@@ -1311,37 +1716,41 @@ class TricodeCLI(App):
         self._update_render_window(event.list_view.index)
     
     def on_custom_text_area_checkpoint_requested(self, event: CustomTextArea.CheckpointRequested) -> None:
+        if self.session is None:
+            return
         checkpoints = []
-        for msg in self.session.messages:
+        # Position and object of each user message, so the cut needs no rescan
+        user_messages = []
+        for idx, msg in enumerate(self.session.messages):
             if msg.get("role") == "user":
                 checkpoints.append(msg.get("content", ""))
+                user_messages.append((idx, msg))
         
         if not checkpoints:
             return
         
         def handle_checkpoint_selection(selected_index: int | None) -> None:
-            if selected_index is not None:
-                checkpoint_msg_idx = 0
-                cut_index = -1
-                selected_user_content = ""
-                
-                for idx, msg in enumerate(self.session.messages):
-                    if msg.get("role") == "user":
-                        if checkpoint_msg_idx == selected_index:
-                            cut_index = idx
-                            selected_user_content = msg.get("content", "")
-                            break
-                        checkpoint_msg_idx += 1
+            if selected_index is not None and 0 <= selected_index < len(user_messages):
+                cut_index, cut_msg = user_messages[selected_index]
+                selected_user_content = checkpoints[selected_index]
+                messages = self.session.messages
+                # compaction may have replaced the list while the picker was open
+                if cut_index >= len(messages) or messages[cut_index] is not cut_msg:
+                    return
                 
                 if cut_index >= 1:
                     self.session.messages = self.session.messages[:cut_index]
-                    save_session(self.session_id, self.session.messages)
+                    self.session.save(full=True)
                     
-                    input_widget = self.query_one("#input", CustomTextArea)
+                    input_widget = self._input
                     input_widget.text = selected_user_content
                     input_widget.move_cursor((0, len(selected_user_content)))
                     
-                    self.message_history = [msg.get("content") for msg in self.session.messages if msg.get("role") == "user"]
+                    if len(self.message_history) == len(checkpoints):
+                        # input history mirrors the user turns; keep those before the cut
+                        del self.message_history[selected_index:]
+                    else:
+                        self.message_history = [msg.get("content") for msg in self.session.messages if msg.get("role") == "user"]
                     self.history_index = -1
                     
                     hist_input, hist_output, hist_total = self.session.calculate_history_tokens()
@@ -1355,22 +1764,22 @@ class TricodeCLI(App):
                     self._append_info_line("[dim]Message restored to input box for editing[/dim]")
                     self._append_info_line(f"Session ID: {self.session_id}")
                     
-                    token_stats = self.query_one("#token_stats", Static)
                     token_text = f"↑ {hist_input} tokens  ↓ {hist_output} tokens  total: {hist_total} tokens"
-                    token_stats.update(token_text)
+                    self._token_pending = None
+                    self._token_stats.update(token_text)
                     
                     input_widget.focus()
         
         self.push_screen(CheckpointListScreen(checkpoints), handle_checkpoint_selection)
     
     async def _send_message(self) -> None:
-        input_widget = self.query_one("#input", CustomTextArea)
+        input_widget = self._input
         message = input_widget.text.strip()
         
         if not message:
             return
         
-        if self.agent_running:
+        if self.agent_running or self.session is None:
             return
         
         self.message_history.append(message)
@@ -1382,50 +1791,63 @@ class TricodeCLI(App):
         self._start_loading()
         self.run_worker(self._process_response(message), exclusive=False)
     
+    # Agent event handlers, dispatched through self._event_handlers
+    def _on_token_update(self, event: dict) -> None:
+        self._token_update_throttled(event['input_tokens'], event['output_tokens'], event['total_tokens'])
+
+    def _on_tool_call(self, event: dict) -> None:
+        self._append_tool_call(event['formatted'])
+
+    def _on_tool_result(self, event: dict) -> None:
+        self._append_tool_result(event.get('name'), event['success'], event['result'], event['formatted'], event.get('args', {}))
+
+    def _on_assistant_delta(self, event: dict) -> None:
+        self._append_agent_delta(event['content'])
+
+    def _on_assistant_message(self, event: dict) -> None:
+        self._append_agent_message(event['content'])
+
+    def _on_error(self, event: dict) -> None:
+        self._append_info_line("[bold red]Error:[/bold red] " + rich_escape(str(event['content'])))
+
+    def _on_compacted(self, event: dict) -> None:
+        self._append_info_line("[dim]" + rich_escape(event['content']) + "[/dim]")
+
+    def _on_cancelled(self, event: dict) -> None:
+        self._append_info_line("[bold yellow]Request cancelled by user[/bold yellow]")
+
+    def _on_denied_request(self, event: dict) -> None:
+        # Permission dialog denial: stop current request, keep TUI alive
+        self._append_info_line("[bold yellow]Operation denied. Current request cancelled.[/bold yellow] " + rich_escape(str(event['content'])))
+
     async def _process_response(self, message: str) -> None:
-        token_stats = self.query_one("#token_stats", Static)
-        
+        # Runs on the event loop, so UI updates are direct calls.
+        handlers = self._event_handlers
+
         def display_event(event):
-            if event["type"] == "round":
-                pass
-            
-            elif event["type"] == "token_update":
-                self.call_from_thread(lambda e=event: self._token_update_throttled(e['input_tokens'], e['output_tokens'], e['total_tokens']))
-            
-            elif event["type"] == "tool_call":
-                self.call_from_thread(lambda e=event: self._append_tool_call(e['formatted']))
-            
-            elif event["type"] == "tool_result":
-                self.call_from_thread(lambda e=event: self._append_tool_result(e.get('name'), e['success'], e['result'], e['formatted'], e.get('args', {})))
-            
-            elif event["type"] == "assistant_message":
-                self.call_from_thread(lambda e=event: self._append_agent_message(e['content']))
-            
-            elif event["type"] == "error":
-                self.call_from_thread(lambda e=event: self._append_info_line("[bold red]Error:[/bold red] " + rich_escape(str(e['content']))))
-            
-            elif event["type"] == "cancelled":
-                self.call_from_thread(lambda: self._append_info_line("[bold yellow]Request cancelled by user[/bold yellow]"))
-            
-            elif event["type"] == "denied_request":
-                # Permission dialog denial: stop current request, keep TUI alive
-                self.call_from_thread(lambda e=event: self._append_info_line("[bold yellow]Operation denied. Current request cancelled.[/bold yellow] " + rich_escape(str(e['content']))))
-        
-        def process_in_thread():
-            try:
-                for event in self.session.send_message(message, lambda: self.cancel_requested):
-                    if self.cancel_requested:
-                        display_event({"type": "cancelled"})
-                        break
-                    display_event(event)
-            except tools_module.PermissionDeniedTerminate as e:
-                display_event({"type": "denied_request", "content": str(e)})
-            except Exception as e:
-                display_event({"type": "error", "content": str(e)})
+            event_type = event["type"]
+            if event_type not in ("assistant_delta", "token_update", "round"):
+                # keep buffered reply text ahead of the next item in the output
+                self._flush_agent_delta()
+            handler = handlers.get(event_type)
+            if handler is not None:
+                handler(event)
         
+        events = self.session.stream_message(message, lambda: self.cancel_requested)
         try:
-            await asyncio.to_thread(process_in_thread)
+            async for event in events:
+                if self.cancel_requested:
+                    display_event({"type": "cancelled"})
+                    break
+                display_event(event)
+        except tools_module.PermissionDeniedTerminate as e:
+            display_event({"type": "denied_request", "content": str(e)})
+        except Exception as e:
+            display_event({"type": "error", "content": str(e)})
         finally:
+            await events.aclose()
+            self._flush_agent_delta()
+            self._streaming_body = None
             self._stop_loading()
     
     def action_cancel_request(self) -> None:
@@ -1437,7 +1859,7 @@ class TricodeCLI(App):
         self.exit()
     
     async def action_new_session(self) -> None:
-        self.session_id = str(uuid.uuid4())[:8]
+        self.session_id = secrets.token_hex(4)
         set_session_id(self.session_id)
         self.session = AgentSession(
             self.session_id, 
@@ -1446,7 +1868,8 @@ class TricodeCLI(App):
             self.model, 
             self.provider,
             self.allowed_tools,
-            self.debug_mode
+            self.debug_mode,
+            on_warning=self._notify_warning
         )
         
         self.message_history = []
@@ -1457,56 +1880,20 @@ class TricodeCLI(App):
         self._append_info_line(f"Session ID: {self.session_id}")
         self._append_info_line("[dim]Press Enter to send, backslash+Enter for newline[/dim]")
         
-        token_stats = self.query_one("#token_stats", Static)
-        token_stats.update("↑ 0 tokens  ↓ 0 tokens  total: 0 tokens")
+        self._token_pending = None
+        self._token_stats.update("↑ 0 tokens  ↓ 0 tokens  total: 0 tokens")
         
-        self.query_one("#input", CustomTextArea).focus()
+        self._input.focus()
     
-    def action_resume_session(self) -> None:
-        sessions = get_available_sessions()
+    async def action_resume_session(self) -> None:
+        sessions = await asyncio.to_thread(get_available_sessions, True)
         if not sessions:
             self._append_info_line("[bold red]No sessions available to resume[/bold red]")
             return
         
         def handle_session_selection(selected_session_id: str | None) -> None:
             if selected_session_id:
-                try:
-                    messages = load_session(selected_session_id)
-                    self.session_id = selected_session_id
-                    set_session_id(self.session_id)
-                    restore_plan(self.session_id)
-                    
-                    self.session = AgentSession(
-                        self.session_id,
-                        messages,
-                        self.client,
-                        self.model,
-                        self.provider,
-                        self.allowed_tools,
-                        self.debug_mode
-                    )
-                    
-                    hist_input, hist_output, hist_total = self.session.calculate_history_tokens()
-                    self.session.input_tokens = hist_input
-                    self.session.output_tokens = hist_output
-                    self.session.total_tokens = hist_total
-                    
-                    self.message_history = [msg.get("content") for msg in messages if msg.get("role") == "user"]
-                    self.history_index = -1
-                    
-                    start_idx = max(0, len(messages) - self.history_window_size)
-                    self._rebuild_from_messages(start_idx)
-                    self._append_info_line("[bold #ff8c00]Session Resumed[/bold #ff8c00]")
-                    self._append_info_line(f"Session ID: {self.session_id}")
-                    self._append_info_line("[dim]Press Enter to send, backslash+Enter for newline[/dim]")
-                    
-                    token_stats = self.query_one("#token_stats", Static)
-                    token_text = f"↑ {hist_input} tokens  ↓ {hist_output} tokens  total: {hist_total} tokens"
-                    token_stats.update(token_text)
-                    
-                    self.query_one("#input", CustomTextArea).focus()
-                except Exception as e:
-                    self._append_info_line("[bold red]Failed to resume session: " + rich_escape(str(e)) + "[/bold red]")
+                self.run_worker(self._resume_session(selected_session_id), exclusive=False)
         
         self.push_screen(SessionListScreen(sessions), handle_session_selection)
     
@@ -1517,9 +1904,20 @@ class TricodeCLI(App):
         self._append_info_line("[dim]Press Enter to send, backslash+Enter for newline[/dim]")
 
 
+def _install_uvloop() -> None:
+    # optional libuv-backed loop; asyncio.run() inside app.run() picks up the policy
+    if sys.platform == "win32":
+        return
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 def run_tui(work_dir: str = None, bypass_work_dir_limit: bool = False, bypass_permission: bool = False, allowed_tools: list = None, 
             override_system_prompt: bool = False, resume_session_id: str = None, debug: bool = False, provider_name: str = None):
     config = load_config()
+    _install_uvloop()
     
     app = TricodeCLI(
         config=config,
@@ -104,6 +104,7 @@ if exist tricode.spec (
         --hidden-import=tiktoken_ext ^
         --hidden-import=tiktoken_ext.openai_public ^
         --collect-data tiktoken_ext ^
+        --add-data "agent/tui.tcss;agent" ^
         tricode.py
 )
 
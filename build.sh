@@ -90,6 +90,7 @@ else
         --hidden-import=tiktoken_ext \
         --hidden-import=tiktoken_ext.openai_public \
         --collect-data tiktoken_ext \
+        --add-data "agent/tui.tcss:agent" \
         tricode.py
 fi
 
@@ -12,8 +12,6 @@ import tarfile
 import zipfile
 import asyncio
 from agent import run_agent, list_conversations
-from agent.tui import run_tui
-from agent.mcp_server import run_mcp_server
 
 try:
     from version import get_runtime_version, get_full_version_string, __version__, __commit_id__
@@ -332,6 +330,7 @@ Examples:
         return
 
     if args.mcp_server:
+        from agent.mcp_server import run_mcp_server
         asyncio.run(run_mcp_server(
             work_dir=args.work_dir,
             bypass_work_dir_limit=args.bypass_work_directory_limit,
@@ -346,6 +345,8 @@ Examples:
             if 'plan' not in allowed_tools:
                 allowed_tools.insert(0, 'plan')
         
+        # Textual is only needed for the TUI
+        from agent.tui import run_tui
         run_tui(
             work_dir=args.work_dir,
             bypass_work_dir_limit=args.bypass_work_directory_limit,
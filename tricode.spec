@@ -18,7 +18,7 @@ a = Analysis(
     ['tricode.py'],
     pathex=[],
     binaries=[],
-    datas=tiktoken_datas + tiktoken_ext_datas,
+    datas=tiktoken_datas + tiktoken_ext_datas + [('agent/tui.tcss', 'agent')],
     hiddenimports=tiktoken_hidden + tiktoken_ext_hidden + ddgs_hidden + ['tiktoken_ext.openai_public'],
     hookspath=[],
     hooksconfig={},